@@ -1,132 +1,359 @@
 import argparse
-import json
-import socket
+import asyncio
+import collections
+import functools
+import random
 import sys
+import time
+import traceback
+
+from tau_core.event_log import Consumer, default_path
+
+# Seconds to wait before looking for new events again
+POLL_INTERVAL = 0.5
+# Seconds between reconnect attempts, doubling up to the maximum
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 300
+# Seconds without a line from the server before pinging it, and then
+# before giving up on a connection that went dead without closing
+PING_INTERVAL = 120
+CONNECT_TIMEOUT = 30
+# Task IDs listed in a digest line before the rest are left out
+MAX_DIGEST_IDS = 10
+# Events read whose lines aren't sent yet, such as those held back for a
+# digest, before reading more waits
+MAX_UNSENT_EVENTS = 1000
+
+# A line to send. Notifications with the same channel, user and digest
+# can be summed up in one line, where digest is the action with {tasks}
+# standing for the tasks it was done to.
+Notification = collections.namedtuple(
+    "Notification", ["channel", "user", "digest", "id", "project", "text"])
+
+# Lets a channel send a burst of lines at once, then one line every
+# 1/rate seconds, which keeps the bot under the network's flood limits
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
 
 class IRC:
-    irc = socket.socket()
-  
-    def __init__(self):  
-        self.irc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-    def send(self, chan, msg):
-        self.irc.send(bytes("PRIVMSG " + chan + " :" + msg + "\n", "UTF-8"))
-
-    def connect(self, server, port, channels, botnick):
-        print("connecting to: "+server+":"+str(port))
-        self.irc.connect((server, port))
-        self.irc.send(bytes("USER " + botnick + " " + botnick +" " + botnick + " :notifier\n", "UTF-8"))
-        self.irc.send(bytes("NICK " + botnick + "\n", "UTF-8"))
-        for chan in channels:
-            self.irc.send(bytes("JOIN " + chan + "\n", "UTF-8"))
 
-# parse arguments
-parser = argparse.ArgumentParser(description='IRC bot to send a pipe to an IRC channel')
-parser.add_argument('--server',default='127.0.0.1', help='IRC server')
-parser.add_argument('--port', default=11066, help='port of the IRC server')
-parser.add_argument('--nickname', help='bot nickname in IRC')
-parser.add_argument('--channel', default="#dev", action='append', help='channel to join')
-parser.add_argument('--pipe', default="/tmp/tau2" , help='pipe to read from')
-parser.add_argument('--skip', default="prv", help='Project or Tags to skip notifications for')
-parser.add_argument('--alt-chan', default="#test", required='--skip' in sys.argv, help='Alternative channel to send notifications to when there are skipped tasks')
+    def __init__(self, server, port, botnick, channels, rate, burst, backlog):
+        self.server = server
+        self.port = port
+        self.botnick = botnick
+        self.channels = channels
+        self.writer = None
+        self.delay = RECONNECT_DELAY
+        # Set once registered and joined, cleared while reconnecting
+        self.connected = asyncio.Event()
+        # Lines waiting to be sent to each channel. When full, reading
+        # the event log waits rather than holding more in memory.
+        self.queues = {chan: asyncio.Queue(backlog) for chan in channels}
+        self.buckets = {chan: TokenBucket(rate, burst) for chan in channels}
+        # Tasks sending each channel's queue, kept so they aren't
+        # garbage collected while running
+        self.senders = set()
+
+    # done is called once the line was written to the server
+    async def send(self, chan, msg, done=None):
+        await self.queues[chan].put((msg, done))
+
+    def write(self, line):
+        self.writer.write(bytes(line + "\r\n", "UTF-8"))
+
+    async def send_queued(self, chan):
+        queue, bucket = self.queues[chan], self.buckets[chan]
+        while True:
+            msg, done = await queue.get()
+            await bucket.take()
+            # Kept until written, so it is sent again after a reconnect
+            while True:
+                await self.connected.wait()
+                try:
+                    self.write("PRIVMSG " + chan + " :" + msg)
+                    await self.writer.drain()
+                    break
+                except OSError:
+                    self.connected.clear()
+            queue.task_done()
+            if done is not None:
+                done()
 
-args = parser.parse_args()
+    # Senders only stop on a bug, after which their channel stays silent
+    def sender_done(self, sender):
+        self.senders.discard(sender)
+        if not sender.cancelled() and sender.exception() is not None:
+            traceback.print_exception(sender.exception())
 
-channels = [args.channel, args.alt_chan] if args.alt_chan is not None else args.channel
+    async def run(self):
+        for chan in self.channels:
+            sender = asyncio.create_task(self.send_queued(chan))
+            self.senders.add(sender)
+            sender.add_done_callback(self.sender_done)
+        while True:
+            try:
+                await self.connect()
+                await self.handle_lines()
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f"error: IRC connection failed: {e!r}", file=sys.stderr)
+            except Exception:
+                # A bug handling a line shouldn't stop the bot for good
+                traceback.print_exc()
+            self.connected.clear()
+            if self.writer is not None:
+                self.writer.close()
+            # Jitter keeps several bots from reconnecting in lockstep
+            wait = self.delay * random.uniform(0.5, 1)
+            print(f"reconnecting in {wait:.0f}s")
+            await asyncio.sleep(wait)
+            self.delay = min(self.delay * 2, MAX_RECONNECT_DELAY)
 
-irc = IRC()
-irc.connect(args.server, args.port, channels, args.nickname)
+    async def connect(self):
+        print("connecting to: "+self.server+":"+str(self.port))
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server, self.port), CONNECT_TIMEOUT)
+        nick = self.botnick
+        self.write("USER " + nick + " " + nick + " " + nick + " :notifier")
+        self.write("NICK " + nick)
+        await self.writer.drain()
 
-while True:
-    with open(args.pipe) as handle:
+    async def handle_lines(self):
+        nick = self.botnick
+        pinged = False
         while True:
-            log_line = handle.readline()
-            if not log_line:
-                break
-            print(log_line)
+            try:
+                line = await asyncio.wait_for(self.reader.readline(),
+                                              PING_INTERVAL)
+            except asyncio.TimeoutError:
+                # A connection that died without closing stays quiet
+                # forever, so check it still answers
+                if pinged:
+                    raise ConnectionError("no reply to PING")
+                self.write("PING :" + self.server)
+                await self.writer.drain()
+                pinged = True
+                continue
+            if not line:
+                raise ConnectionError("connection closed by server")
+            pinged = False
+            line = line.decode("UTF-8", errors="replace").rstrip("\r\n")
+            # Messages from the server start with a :prefix
+            if line.startswith(":"):
+                line = line.partition(" ")[2]
+            command, _, params = line.partition(" ")
+            if command == "PING":
+                self.write("PONG " + params)
+            # Welcome, so registration is done and channels can be joined
+            elif command == "001":
+                for chan in self.channels:
+                    self.write("JOIN " + chan)
+                self.connected.set()
+                self.delay = RECONNECT_DELAY
+            # Nickname in use
+            elif command == "433":
+                nick += "_"
+                self.write("NICK " + nick)
+            await self.writer.drain()
+
+# Returns the notifications to send for an event
+def format_event(msg, args):
+    cmd = msg['update']
+    user = msg['params'][0]
+    id = msg['params'][1]
+    task = msg['params'][2]
+    title = task['title']
+
+    channel = args.channel
+    project = task['project'] if task['project'] is not None else []
+    if args.skip in project or args.skip in task['tags']:
+        channel = args.alt_chan
+
+    notifications = []
+    if cmd == "add_task":
+        assigned = ", @".join(task['assigned'])
+        if len(assigned) > 0:
+            notifications.append(("added {tasks}", f"{user} added task ({id}): {title}. assigned to @{assigned}"))
+        else:
+            notifications.append(("added {tasks}", f"{user} added task ({id}): {title}"))
+    elif cmd == "modify_task":
+        action = msg['params'][3]
+        assignees = []
+        removed_assignees = []
+        for act in action:
+            if act[1] == "assigned":
+                if act[0] == "append":
+                    assignees.append(act[2])
+                if act[0] == "remove":
+                    removed_assignees.append(act[2])
+
+        assignees = ", @".join(assignees)
+        if len(assignees) > 0:
+            notifications.append((f"assigned {{tasks}} to @{assignees}", f"{user} modified task ({id}): {title}, action: assigned to @{assignees}"))
+        removed_assignees = ", @".join(removed_assignees)
+        if len(removed_assignees) > 0:
+            notifications.append((f"removed @{removed_assignees} from {{tasks}}", f"{user} modified task ({id}): {title}, action: removed @{removed_assignees}"))
+    elif cmd == "add_task_comment":
+        notifications.append(("commented on {tasks}", f"{user} commented on task ({id}): {title}"))
+    elif cmd == "change_task_status":
+        state = msg['params'][3]
+        if state == "start":
+            notifications.append(("started {tasks}", f"{user} started task ({id}): {title}"))
+        elif state == "pause":
+            notifications.append(("paused {tasks}", f"{user} paused task ({id}): {title}"))
+        elif state == "stop":
+            notifications.append(("stopped {tasks}", f"{user} stopped task ({id}): {title}"))
+        elif state == "cancel":
+            notifications.append(("canceled {tasks}", f"{user} canceled task ({id}): {title}"))
+    return [Notification(channel, user, digest, id, task['project'], text)
+            for digest, text in notifications]
+
+# Sums up bursts of similar notifications, such as a scripted bulk edit,
+# in one line. The first of a kind is sent right away, so a quiet stream
+# sees no delay, and those following it within the window are gathered
+# into a digest sent when the window ends.
+class Coalescer:
+
+    def __init__(self, irc, window):
+        self.irc = irc
+        self.window = window
+        # (channel, user, digest) -> notifications held back
+        self.groups = {}
+        self.timers = set()
+
+    # done is called once the notification was sent, alone or in a digest
+    async def send(self, note, done):
+        if self.window <= 0:
+            await self.irc.send(note.channel, note.text, done)
+            return
+        key = (note.channel, note.user, note.digest)
+        if key in self.groups:
+            self.groups[key].append((note, done))
+            return
+        self.groups[key] = []
+        await self.irc.send(note.channel, note.text, done)
+        timer = asyncio.create_task(self.close_window(key))
+        self.timers.add(timer)
+        timer.add_done_callback(self.timers.discard)
+
+    async def close_window(self, key):
+        await asyncio.sleep(self.window)
+        held = self.groups.pop(key)
+        if not held:
+            return
+        notes = [note for note, _ in held]
+        def done():
+            for _, note_done in held:
+                note_done()
+        if len(notes) == 1:
+            await self.irc.send(notes[0].channel, notes[0].text, done)
+        else:
+            await self.irc.send(notes[0].channel, digest_line(notes), done)
+
+# For example "alice started 13 more tasks in project core (2, 3, 4)"
+def digest_line(notes):
+    tasks = f"{len(notes)} more tasks"
+    projects = {note.project for note in notes}
+    if len(projects) == 1 and None not in projects:
+        tasks += f" in project {projects.pop()}"
+    ids = ", ".join(str(note.id) for note in notes[:MAX_DIGEST_IDS])
+    if len(notes) > MAX_DIGEST_IDS:
+        ids += ", ..."
+    return f"{notes[0].user} {notes[0].digest.format(tasks=tasks)} ({ids})"
+
+# Saves the consumer's position after the events whose lines were all
+# sent, never past one still waiting, so none are lost if the bot stops
+class Progress:
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        # [position after the event, lines left to send], in log order
+        self.events = collections.deque()
+        self.changed = asyncio.Event()
+
+    def add(self, position, lines):
+        entry = [position, lines]
+        self.events.append(entry)
+        return entry
+
+    def sent(self, entry):
+        entry[1] -= 1
+        self.advance()
+
+    def advance(self):
+        position = None
+        while self.events and self.events[0][1] == 0:
+            position = self.events.popleft()[0]
+        if position is not None:
+            self.consumer.commit(position)
+            self.changed.set()
+
+    async def wait_below(self, count):
+        while len(self.events) >= count:
+            self.changed.clear()
+            await self.changed.wait()
+
+# Moves events from the log to the channel queues. Reading goes on while
+# notifications are held back for a digest, other events aren't delayed.
+async def relay_events(consumer, coalescer, args):
+    progress = Progress(consumer)
+    while True:
+        await progress.wait_below(MAX_UNSENT_EVENTS)
+        events = consumer.read_positions(args.backlog)
+        if not events:
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+        for msg, position in events:
+            print(msg)
             print("======================================")
-            msg = json.loads(log_line)
-            cmd = msg['update']
-            channel = args.channel
-
-            if cmd == "add_task":
-                user = msg['params'][0]
-                id = msg['params'][1]
-                task = msg['params'][2]
-                title = task['title']
-                assigned = ", @".join(task['assigned'])
-
-                project = task['project'] if task['project'] is not None else []
-                if args.skip in project or args.skip in task['tags']:
-                    channel = args.alt_chan
-
-                if len(assigned) > 0:
-                    notification = f"{user} added task ({id}): {title}. assigned to @{assigned}"
-                else:
-                    notification = f"{user} added task ({id}): {title}"
-                print(notification)
-                irc.send(channel, notification)
-            elif cmd == "modify_task":
-                user = msg['params'][0]
-                id = msg['params'][1]
-                task = msg['params'][2]
-                action = msg['params'][3]
-                title = task['title']
-
-                project = task['project'] if task['project'] is not None else []
-                if args.skip in project or args.skip in task['tags']:
-                    channel = args.alt_chan
-
-                assignees = []
-                removed_assignees = []
-                for act in action:
-                    if act[1] == "assigned":
-                        if act[0] == "append":
-                            assignees.append(act[2])
-                        if act[0] == "remove":
-                            removed_assignees.append(act[2])
-
-                assignees = ", @".join(assignees)
-                if len(assignees) > 0:
-                    notification = f"{user} modified task ({id}): {title}, action: assigned to @{assignees}"
-                    print(notification)
-                    irc.send(channel, notification)
-                removed_assignees = ", @".join(removed_assignees)
-                if len(removed_assignees) > 0:
-                    notification = f"{user} modified task ({id}): {title}, action: removed @{removed_assignees}"
-                    print(notification)
-                    irc.send(channel, notification)
-            elif cmd == "add_task_comment":
-                user = msg['params'][0]
-                id = msg['params'][1]
-                task = msg['params'][2]
-                title = task['title']
-                
-                project = task['project'] if task['project'] is not None else []
-                if args.skip in project or args.skip in task['tags']:
-                    channel = args.alt_chan
-
-                notification = f"{user} commented on task ({id}): {title}"
-                print(notification)
-                irc.send(channel, notification)
-            elif cmd == "change_task_status":
-                user = msg['params'][0]
-                id = msg['params'][1]
-                task = msg['params'][2]
-                state = msg['params'][3]
-                title = task['title']
-
-                project = task['project'] if task['project'] is not None else []
-                if args.skip in project or args.skip in task['tags']:
-                    channel = args.alt_chan
-
-                if state == "start":
-                    notification = f"{user} started task ({id}): {title}"
-                elif state == "pause":
-                    notification = f"{user} paused task ({id}): {title}"
-                elif state == "stop":
-                    notification = f"{user} stopped task ({id}): {title}"
-                elif state == "cancel":
-                    notification = f"{user} canceled task ({id}): {title}"
-                print(notification)
-                irc.send(channel, notification)
\ No newline at end of file
+            notes = format_event(msg, args)
+            entry = progress.add(position, len(notes))
+            for note in notes:
+                print(note.text)
+                await coalescer.send(note, functools.partial(progress.sent, entry))
+        # Events without any lines to send
+        progress.advance()
+
+async def main(args):
+    channels = [args.channel]
+    if args.alt_chan is not None and args.alt_chan != args.channel:
+        channels.append(args.alt_chan)
+
+    irc = IRC(args.server, args.port, args.nickname, channels,
+              args.rate, args.burst, args.backlog)
+    coalescer = Coalescer(irc, args.digest_window)
+    consumer = Consumer(args.log, args.consumer)
+    await asyncio.gather(irc.run(), relay_events(consumer, coalescer, args))
+
+# parse arguments
+parser = argparse.ArgumentParser(description='IRC bot to send the tau event log to an IRC channel')
+parser.add_argument('--server',default='127.0.0.1', help='IRC server')
+parser.add_argument('--port', default=11066, type=int, help='port of the IRC server')
+parser.add_argument('--nickname', help='bot nickname in IRC')
+parser.add_argument('--channel', default="#dev", help='channel to join')
+parser.add_argument('--log', default=default_path(), help='event log directory to read from')
+parser.add_argument('--consumer', default="irc", help='name the read position is saved under')
+parser.add_argument('--skip', default="prv", help='Project or Tags to skip notifications for')
+parser.add_argument('--alt-chan', default="#test", required='--skip' in sys.argv, help='Alternative channel to send notifications to when there are skipped tasks')
+parser.add_argument('--rate', default=0.5, type=float, help='lines per second sent to a channel once a burst is used up')
+parser.add_argument('--burst', default=5, type=int, help='lines a channel can send at once')
+parser.add_argument('--backlog', default=100, type=int, help='lines held in memory per channel')
+parser.add_argument('--digest-window', default=5, type=float, help='seconds similar notifications are gathered into one line, 0 to send each')
+
+if __name__ == "__main__":
+    asyncio.run(main(parser.parse_args()))
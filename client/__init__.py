@@ -4,4 +4,4 @@ def main():
     """Entry point for tau command"""
     # Import here to avoid circular import
     import client.main as client_main
-    asyncio.run(client_main.main())
\ No newline at end of file
+    asyncio.run(client_main.run())
\ No newline at end of file
@@ -2,8 +2,12 @@
 """tau2 client API - RPC wrapper"""
 from tau_core.rpc_client import RPCClient
 
-# Create RPC client for tau2 server
-client = RPCClient(port=7643)
+# Create RPC client for tau2 server. Reads can be retried when the
+# connection drops, changes can't since they may have been applied.
+client = RPCClient(port=7643, idempotent=[
+    "get_info", "get_stats", "fetch_active_tasks", "fetch_deactive_tasks",
+    "query_tasks", "fetch_changes_since", "search", "fetch_task",
+    "fetch_archive_task"])
 
 
 async def get_info():
@@ -14,12 +18,57 @@ async def add_task(who, task):
     return await client.query("add_task", [who, task])
 
 
-async def fetch_active_tasks():
-    return await client.query("fetch_active_tasks", [])
+# fields is a list of attributes or a view name such as "summary".
+# Leave it out to fetch the whole tasks.
+async def fetch_active_tasks(fields=None):
+    params = [] if fields is None else [fields]
+    return await client.query("fetch_active_tasks", params)
 
 
-async def fetch_deactive_tasks(month):
-    return await client.query("fetch_deactive_tasks", [month])
+async def fetch_deactive_tasks(month, fields=None):
+    params = [month] if fields is None else [month, fields]
+    return await client.query("fetch_deactive_tasks", params)
+
+
+async def query_tasks(filters, sort=None, limit=None, fields=None):
+    return await client.query("query_tasks", [filters, sort, limit, fields])
+
+
+async def fetch_changes_since(seq, epoch=None, fields=None):
+    return await client.query("fetch_changes_since", [seq, epoch, fields])
+
+
+# Yields the pages of [id, task] pairs from a paged listing. Each page
+# is only requested once the previous one was consumed.
+async def pages(method, params, page_size):
+    cursor = None
+    while True:
+        page = await client.query(method, params + [page_size, cursor])
+        yield page["tasks"]
+        if (cursor := page["cursor"]) is None:
+            return
+
+
+def page_active_tasks(page_size, fields=None):
+    return pages("fetch_active_tasks", [fields], page_size)
+
+
+def page_deactive_tasks(month, page_size, fields=None):
+    return pages("fetch_deactive_tasks", [month, fields], page_size)
+
+
+def page_query_tasks(page_size, filters, sort=None, limit=None, fields=None):
+    return pages("query_tasks", [filters, sort, limit, fields], page_size)
+
+
+async def search(text, limit=20):
+    return await client.query("search", [text, limit])
+
+
+# Yields each change to the active tasks matching the filters as it
+# happens, see subscribe in server/api.py
+def subscribe(filters):
+    return client.subscribe("subscribe", [filters])
 
 
 async def fetch_task(task_id):
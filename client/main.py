@@ -5,10 +5,13 @@ from tabulate import tabulate
 from colorama import Fore, Back, Style
 
 import api
+import replica
 import tau_core.config
 import tau_core.util
 
-USERNAME = tau_core.config.get("username", "Anonymous")
+USERNAME = tau_core.config.get_str("username", "Anonymous")
+# Tasks fetched per request when listing into a pipe or pager
+PAGE_SIZE = 100
 
 async def add_task(task_args):
     task = {
@@ -144,23 +147,67 @@ def convert_attr_val(attr, val):
         print(f"error: unhandled attr '{attr}' = {val}")
         sys.exit(-1)
 
-async def show_active_tasks():
-    tasks = await api.fetch_active_tasks()
-    list_tasks(tasks, [])
+# The server does the filtering, see server/query.py for the grammar
+async def show_active_tasks(filters=[], sort="-rank", limit=None):
+    # The plain listing is served from the local replica
+    if not filters and sort == "-rank" and limit is None:
+        rows = sort_by_rank(await replica.sync("summary"))
+        if not sys.stdout.isatty():
+            await stream_tasks(local_pages(rows))
+            return
+        list_tasks(rows)
+        return
+    if not sys.stdout.isatty():
+        await stream_tasks(api.page_query_tasks(
+            PAGE_SIZE, filters, sort, limit, "summary"))
+        return
+    rows = await api.query_tasks(filters, sort, limit, "summary")
+    list_tasks(rows)
 
 async def show_deactive_tasks(month):
-    tasks = await api.fetch_deactive_tasks(month)
-    list_tasks(tasks, [])
-
-def list_tasks(tasks, filters):
+    if not sys.stdout.isatty():
+        # Listed in the order they were archived
+        await stream_tasks(api.page_deactive_tasks(month, PAGE_SIZE, "summary"))
+        return
+    tasks = await api.fetch_deactive_tasks(month, "summary")
+    rows = [(id, task) for id, task in enumerate(tasks) if task is not None]
+    rows.sort(key=lambda row: row[1]["rank"] if row[1]["rank"] is not None
+              else 0, reverse=True)
+    list_tasks(rows)
+
+# Highest rank first, the same order as the server's "-rank"
+def sort_by_rank(rows):
+    ranked = [row for row in rows if row[1]["rank"] is not None]
+    unranked = [row for row in rows if row[1]["rank"] is None]
+    ranked.sort(key=lambda row: (row[1]["rank"], row[0]), reverse=True)
+    return ranked + unranked
+
+# Splits rows already at hand into pages for stream_tasks()
+async def local_pages(rows):
+    for start in range(0, len(rows), PAGE_SIZE):
+        yield rows[start:start + PAGE_SIZE]
+
+# Prints pages as they arrive so a pager shows the first ones right
+# away, and later ones are only fetched as it reads on.
+async def stream_tasks(pages):
+    show_headers = True
+    try:
+        async for rows in pages:
+            list_tasks(rows, show_headers)
+            sys.stdout.flush()
+            show_headers = False
+    except BrokenPipeError:
+        # The pager was closed so stop fetching. Point stdout elsewhere
+        # so flushing it on exit doesn't fail again.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+
+# Prints (id, task) rows in the order given
+def list_tasks(rows, show_headers=True):
     headers = ["ID", "Title", "Status", "Project",
                "Tags", "Assigned", "Rank", "Due"]
-    table_rows = []
-    for id, task in enumerate(tasks):
-        if task is None:
-            continue
-        if is_filtered(task, filters):
-            continue
+    table = []
+    for id, task in rows:
         title = task["title"]
         status = task["status"]
         project = task["project"] if task["project"] is not None else ""
@@ -202,7 +249,6 @@ def list_tasks(tasks, filters):
             rank =      Style.DIM  + str(rank)      + Style.RESET_ALL
             due =       Style.DIM  + str(due)       + Style.RESET_ALL
 
-        rank_value = task["rank"] if task["rank"] is not None else 0
         row = [
             id,
             title,
@@ -213,12 +259,46 @@ def list_tasks(tasks, filters):
             rank,
             due,
         ]
-        table_rows.append((rank_value, row))
+        table.append(row)
 
-    table = [row for (_, row) in
-             sorted(table_rows, key=lambda item: item[0], reverse=True)]
+    if not show_headers:
+        if table:
+            print(tabulate(table, tablefmt="plain"))
+        return
+    print(tabulate(table, headers=headers))
+
+# Archived results are shown with their month, view them
+# using `tau ID archive MMYY`
+async def search_tasks(text):
+    results = await api.search(text)
+    headers = ["ID", "Archive", "Title", "Status", "Project", "Score"]
+    table = []
+    for id, month, score, task in results:
+        project = task["project"] if task["project"] is not None else ""
+        table.append([id, month or "", task["title"], task["status"],
+                      project, f"{score:.2f}"])
     print(tabulate(table, headers=headers))
 
+# Prints a line for every change to the tasks matching the filters
+# until interrupted
+async def watch_tasks(filters):
+    async for event in api.subscribe(filters):
+        update, params = event["update"], event["params"]
+        if update == "overflow":
+            print("warning: missed some changes while falling behind",
+                  file=sys.stderr)
+            continue
+        who, id, task = params[:3]
+        if update == "add_task":
+            change = "added"
+        elif update == "modify_task":
+            change = "modified"
+        elif update == "change_task_status":
+            change = f"set status {params[3]}"
+        else:
+            change = "commented on"
+        print(f"{who} {change} {id}: {task['title']}", flush=True)
+
 async def show_task(id):
     task = await api.fetch_task(id)
     task_table(task)
@@ -412,47 +492,6 @@ async def comment(id, args):
     print(f"Commented on task {id} '{title}'")
     return 0
 
-def is_filtered(task, filters):
-    for fltr in filters:
-        if fltr.startswith("+"):
-            tag = fltr[1:]
-            if tag not in task["tags"]:
-                return True
-        elif fltr.startswith("@"):
-            assign = fltr[1:]
-            if assign not in task["assigned"]:
-                return True
-        elif ":" in fltr:
-            attr, val = fltr.split(":", 1)
-            if val.lower() == "none":
-                if attr not in ["project", "rank", "due"]:
-                    print(f"error: invalid you cannot set {attr} to none",
-                            file=sys.stderr)
-                    sys.exit(-1)
-                if task[attr] is not None:
-                    return True
-            elif attr == "status" :
-                if val not in ["open", "start", "pause"]:
-                    print(f"error: invalid, filter by {attr} can only be [\"open\", \"start\", \"pause\"]",
-                            file=sys.stderr)
-                    sys.exit(-1)
-                if task["status"] != val:
-                    return True
-            elif attr == "project":
-                if task["project"] is None:
-                    return True
-                if not task["project"].startswith(val):
-                    return True
-            else:
-                val = convert_attr_val(attr, val)
-                if task[attr] != val:
-                    return True
-        else:
-            print(f"error: unknown arg '{fltr}'", file=sys.stderr)
-            sys.exit(-1)
-
-    return False
-
 async def main():
     if len(sys.argv) == 1:
         await show_active_tasks()
@@ -471,8 +510,11 @@ SUBCOMMANDS:
     comment    Write comment for task by id.
     modify     Modify an existing task by id.
     pause      Pause task(s).
+    search     Search titles, descriptions and comments.
+    show       Show tasks matching filters.
     start      Start task(s).
     stop       Stop task(s).
+    watch      Print changes to tasks matching filters as they happen.
     help       Show this help text.
 
 Example:
@@ -487,6 +529,11 @@ Example:
     tau archive         # current month's completed tasks
     tau archive 1122    # completed tasks in Nov. 2022
     tau 0 archive 1122  # show info of task completed in Nov. 2022
+    tau show +dev @john
+    tau show project:ops or not +lol
+    tau show due:..0512 sort:due limit:5
+    tau search rpc timeout
+    tau watch project:ops @john
 ''')
         return 0
     elif sys.argv[1] == "add":
@@ -506,13 +553,31 @@ Example:
         await show_deactive_tasks(month)
         return 0
     elif sys.argv[1] == "show":
-        if len(sys.argv) > 2:
-            filters = sys.argv[2:]
-            tasks = await api.fetch_active_tasks()
-            #filtered_tasks = apply_filters(tasks, filters)
-            list_tasks(tasks, filters)
-        else:
-            await show_active_tasks()
+        filters, sort, limit = [], "-rank", None
+        for arg in sys.argv[2:]:
+            if arg.startswith("sort:"):
+                sort = arg[5:]
+            elif arg.startswith("limit:"):
+                try:
+                    limit = int(arg[6:])
+                except ValueError:
+                    print(f"error: limit {arg[6:]} isn't a number",
+                          file=sys.stderr)
+                    return -1
+            else:
+                filters.append(arg)
+        await show_active_tasks(filters, sort, limit)
+        return 0
+
+    elif sys.argv[1] == "search":
+        if len(sys.argv) < 3:
+            print("error: missing search terms", file=sys.stderr)
+            return -1
+        await search_tasks(" ".join(sys.argv[2:]))
+        return 0
+
+    elif sys.argv[1] == "watch":
+        await watch_tasks(sys.argv[2:])
         return 0
 
     try:
@@ -557,6 +622,13 @@ Example:
 
     return 0
 
+# Runs the command, then closes the connections kept to the server
+async def run():
+    try:
+        return await main()
+    finally:
+        await api.client.close()
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(run())
 
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""tau2 client replica - local copy of the active task list"""
+import json, os
+
+import api
+
+# Kept next to the config and brought up to date with only what
+# changed since the last run, so listing tasks on a quiet day costs
+# a single small request.
+REPLICA_PATH = os.path.expanduser("~/.config/tau/replica.json")
+
+
+def load():
+    try:
+        with open(REPLICA_PATH, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save(replica):
+    os.makedirs(os.path.dirname(REPLICA_PATH), exist_ok=True)
+    # Other tau commands may be reading it, so replace it in one go
+    tmp_path = f"{REPLICA_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(replica, f)
+    os.replace(tmp_path, REPLICA_PATH)
+
+
+# Returns the active tasks as (id, task) pairs, after fetching changes
+async def sync(fields="summary"):
+    server = f"{api.client.server}:{api.client.port}"
+    replica = load()
+    if (replica is None or replica["server"] != server
+            or replica["fields"] != fields):
+        replica = {
+            "server": server,
+            "fields": fields,
+            "epoch": None,
+            "seq": 0,
+            "tasks": {},
+        }
+
+    changes = await api.fetch_changes_since(
+        replica["seq"], replica["epoch"], fields)
+    if changes["full"]:
+        replica["tasks"] = {}
+    # JSON object keys are strings
+    for id, task in changes["changes"]:
+        if task is None:
+            replica["tasks"].pop(str(id), None)
+        else:
+            replica["tasks"][str(id)] = task
+
+    if (changes["epoch"], changes["seq"]) != (replica["epoch"], replica["seq"]):
+        replica["epoch"] = changes["epoch"]
+        replica["seq"] = changes["seq"]
+        save(replica)
+
+    return sorted(((int(id), task) for id, task in replica["tasks"].items()),
+                  key=lambda row: row[0])
@@ -1,10 +1,18 @@
-import json, sys
+import copy, json, sys
 
 import tau_core.util
-import pipe, plumbing, util
+from tau_core.event_log import EventLog
+from tau_core.rpc_server import Stream
+import paging, query, store, subscriptions, util
 
 PROTOCOL_VERSION = 1
 
+# Loaded by main.py on startup
+task_store = store.TaskStore()
+subscription_hub = subscriptions.SubscriptionHub()
+# Read by the IRC bot and any other local consumers, see bot/
+event_log = EventLog(f"{util.config_path()}/data/events")
+
 class Error:
 
     def __init__(self, code, msg):
@@ -21,21 +29,40 @@ class Error:
             }
         }
 
-# Write a local event so IRC can update
-def notify(event):
-    message = json.dumps(event)
-    pipe.write_pipe("/tmp/tau2", message)
+# Log an event so IRC can update, and push it to the subscribers
+# interested in the task. before is the task prior to the change.
+def notify(event, before=None):
+    event_log.append(event)
+    task = event["params"][2]
+    subscription_hub.publish(event, [task, before])
 
 async def get_info():
     #return Error(-110, "oopsie")
     return "Hello World"
 
-async def add_task(who, task):
-    plumbing.save_task(task)
+async def get_stats():
+    return {
+        "io_pool": task_store.io.stats(),
+        "locks": task_store.locks.stats(),
+        "index": task_store.index.stats(),
+        "search": task_store.fulltext.stats(),
+        "changes": {"epoch": task_store.epoch, "seq": task_store.seq},
+        "subscriptions": subscription_hub.stats(),
+        "event_log": event_log.stats(),
+    }
 
-    active = plumbing.load_active()
-    id = plumbing.next_free_id(active, task["blob_idx"])
-    plumbing.save_active(active)
+# Due and rank are kept sorted by the indexes so must be comparable
+def is_valid_order_value(val):
+    return val is None or isinstance(val, (int, float))
+
+async def add_task(who, task):
+    if not util.is_valid_blob_idx(task["blob_idx"]):
+        return Error(112, "invalid blob_idx")
+    if not all(is_valid_order_value(task[attr]) for attr in ["due", "rank"]):
+        return Error(111, "invalid attribute")
+    # The history is stored apart from the task's attributes
+    events = task.pop("events", [])
+    id = await task_store.add(task, events)
 
     notify({
             "update": "add_task",
@@ -43,61 +70,214 @@ async def add_task(who, task):
         })
     return id
 
-async def fetch_active_tasks():
-    tasks = []
-    active = plumbing.load_active()
-    for blob_idx in active:
-        if blob_idx is None:
-            tasks.append(None)
+# Keeps only the requested attributes of each task. fields is either
+# a list of attributes or the name of a view in tau_core.util.task_views.
+def project_tasks(tasks, fields):
+    if fields is None:
+        return tasks
+    if isinstance(fields, str):
+        if fields not in tau_core.util.task_views:
+            return Error(113, f"unknown view '{fields}'")
+        fields = tau_core.util.task_views[fields]
+    for field in fields:
+        # The history is only returned for single tasks
+        if field not in tau_core.util.task_template or field == "events":
+            return Error(111, "invalid attribute")
+
+    projected = []
+    for task in tasks:
+        if task is None:
+            projected.append(None)
             continue
+        projected.append({field: task[field] for field in fields})
+    return projected
+
+# Builds a page from rows fetched with an extra one that tells whether
+# more follow. next_cursor(row) gives the cursor to continue after the
+# page's last row, or None if nothing more should be listed.
+def make_page(rows, count, fields, next_cursor):
+    more = len(rows) > count
+    rows = rows[:count]
+    tasks = project_tasks([task for _, task in rows], fields)
+    if isinstance(tasks, Error):
+        return tasks
+    return {
+        "tasks": [[id, task] for (id, _), task in zip(rows, tasks)],
+        "cursor": next_cursor(rows[-1]) if more else None,
+    }
 
-        task = plumbing.load_task(blob_idx)
-        tasks.append(task)
-    return tasks
-
-async def fetch_deactive_tasks(month):
-    tasks = []
-    deactive = plumbing.load_archive(month)
-    for blob_idx in deactive:
-        if blob_idx is None:
-            tasks.append(None)
-            continue
+# Without a page_size these return the whole list, with None for free
+# IDs. Otherwise they return {"tasks": [[id, task], ...], "cursor": c}
+# and c is passed back to get the next page, or is None at the end.
+async def fetch_active_tasks(fields=None, page_size=None, cursor=None):
+    if page_size is None:
+        return project_tasks(task_store.active_tasks(), fields)
+    if not paging.is_valid_page_size(page_size):
+        return Error(115, "invalid page size")
+    after = -1
+    if cursor is not None:
+        try:
+            after = paging.decode_cursor(cursor, "active")
+        except ValueError:
+            return Error(115, "invalid cursor")
+        if not isinstance(after, int):
+            return Error(115, "invalid cursor")
+
+    rows = task_store.active_page(after, page_size + 1)
+    return make_page(rows, page_size, fields,
+                     lambda row: paging.encode_cursor("active", row[0]))
+
+async def fetch_deactive_tasks(month, fields=None, page_size=None,
+                               cursor=None):
+    if page_size is None:
+        return project_tasks(await task_store.archive_tasks(month), fields)
+    if not paging.is_valid_page_size(page_size):
+        return Error(115, "invalid page size")
+    after = -1
+    if cursor is not None:
+        try:
+            cursor_month, after = paging.decode_cursor(cursor, "archive")
+        except (ValueError, TypeError):
+            return Error(115, "invalid cursor")
+        if cursor_month != month or not isinstance(after, int):
+            return Error(115, "invalid cursor")
+
+    rows = await task_store.archive_page(month, after, page_size + 1)
+    return make_page(
+        rows, page_size, fields,
+        lambda row: paging.encode_cursor("archive", [month, row[0]]))
+
+# Returns [id, task] pairs of the active tasks matching the filters,
+# see query.py for the grammar. sort is an attribute, prefixed with "-"
+# for descending order. Pages like the list endpoints when given a
+# page_size, and limit then caps the number of tasks over all pages.
+async def query_tasks(filters, sort=None, limit=None, fields=None,
+                      page_size=None, cursor=None):
+    if limit is not None and (not isinstance(limit, int) or limit < 0):
+        return Error(114, "invalid query: bad limit")
+    if page_size is None:
+        if cursor is not None:
+            return Error(115, "invalid page size")
+        try:
+            fltr = query.compile_filter(filters)
+            rows = task_store.select(fltr, sort, limit)
+        except query.QueryError as e:
+            return Error(114, f"invalid query: {e}")
+
+        tasks = project_tasks([task for _, task in rows], fields)
+        if isinstance(tasks, Error):
+            return tasks
+        return [[id, task] for (id, _), task in zip(rows, tasks)]
+
+    if not paging.is_valid_page_size(page_size):
+        return Error(115, "invalid page size")
+    # The cursor remembers the sort and how many of the limit are left
+    after, left = None, limit
+    if cursor is not None:
+        try:
+            cursor_sort, after, left = paging.decode_cursor(cursor, "query")
+            query.check_position(after, sort)
+        except (ValueError, TypeError, query.QueryError):
+            return Error(115, "invalid cursor")
+        if cursor_sort != sort or not (left is None or
+                                       (isinstance(left, int) and left > 0)):
+            return Error(115, "invalid cursor")
+    count = page_size if left is None else min(page_size, left)
+    try:
+        fltr = query.compile_filter(filters)
+        rows = task_store.select(fltr, sort, count + 1, after)
+    except query.QueryError as e:
+        return Error(114, f"invalid query: {e}")
+
+    def next_cursor(row):
+        remaining = None if left is None else left - count
+        if remaining == 0:
+            return None
+        return paging.encode_cursor(
+            "query", [sort, query.position(row, sort), remaining])
+    return make_page(rows, count, fields, next_cursor)
+
+# Returns what changed in the active list after seq, for clients keeping
+# a copy of it. changes holds [id, task] pairs, with task None for IDs
+# freed by archiving. Sequence numbers restart when the server crashed,
+# so if epoch doesn't match "full" is set and every task is returned
+# instead, to replace the copy with.
+async def fetch_changes_since(seq, epoch=None, fields=None):
+    if not isinstance(seq, int) or seq < 0:
+        return Error(116, "invalid sequence number")
+    full = epoch != task_store.epoch or seq > task_store.seq
+    if full:
+        ids = [id for id, blob_idx in enumerate(task_store.active)
+               if blob_idx is not None]
+    else:
+        ids = task_store.changed_since(seq)
+
+    tasks = project_tasks([task_store.get(id) for id in ids], fields)
+    if isinstance(tasks, Error):
+        return tasks
+    return {
+        "epoch": task_store.epoch,
+        "seq": task_store.seq,
+        "full": full,
+        "changes": [[id, task] for id, task in zip(ids, tasks)],
+    }
 
-        task = plumbing.load_task(blob_idx)
-        tasks.append(task)
-    return tasks
+# Full-text search over the title, description and comments of active
+# and archived tasks. Returns [id, month, score, task] with the best
+# match first, where month is None for active tasks.
+async def search(text, limit=20, fields="summary"):
+    if not isinstance(text, str):
+        return Error(114, "invalid query: search text must be a string")
+    if limit is not None and (not isinstance(limit, int) or limit < 0):
+        return Error(114, "invalid query: bad limit")
+    results = await task_store.search(text, limit)
+
+    tasks = project_tasks([task for _, _, _, task in results], fields)
+    if isinstance(tasks, Error):
+        return tasks
+    return [[id, month, score, task]
+            for (id, month, score, _), task in zip(results, tasks)]
+
+# Keeps the connection open and pushes every change to the active tasks
+# matching the filters, written as for query_tasks. The events are those
+# written to the event log, such as {"update": "add_task", "params": [...]}.
+# A subscriber too slow to keep up gets {"update": "overflow"} in place
+# of the events it missed.
+async def subscribe(filters):
+    try:
+        fltr = query.compile_filter(filters)
+    except query.QueryError as e:
+        return Error(114, f"invalid query: {e}")
+    subscription = subscription_hub.subscribe(fltr)
+    return Stream(True, subscription.events(), subscription.close)
 
 async def fetch_task(id):
-    blob_idx = plumbing.blob_idx_from_id(id)
-    if blob_idx is None:
+    task = task_store.get(id)
+    if task is None:
         return Error(110, "invalid ID")
-    task = plumbing.load_task(blob_idx)
-    return task
+    events = await task_store.events(task["blob_idx"])
+    return dict(task, events=events)
 
 async def fetch_archive_task(id, month):
-    archive = plumbing.load_archive(month)
-    try:
-        archive[id]
-    except IndexError:
+    task = await task_store.archive_task(id, month)
+    if task is None:
         return Error(110, "invalid ID")
-
-    blob_idx = archive[id]
-    if blob_idx is None:
-        return Error(110, "invalid ID")
-    task = plumbing.load_task(blob_idx)
     return task
 
 async def modify_task(who, id, changes):
-    blob_idx = plumbing.blob_idx_from_id(id)
-    if blob_idx is None:
+    before = task_store.get(id)
+    if before is None:
         return Error(110, "invalid ID")
+    # Work on a copy so a failed change leaves the resident task intact
+    task = copy.deepcopy(before)
 
-    task = plumbing.load_task(blob_idx)
-
+    events = []
     for cmd, attr, val in changes:
         if cmd == "set":
             if not attr in ["title", "desc", "project", "due", "rank"]:
                 return Error(111, "invalid attribute")
+            if attr in ["due", "rank"] and not is_valid_order_value(val):
+                return Error(111, "invalid attribute")
             task[attr] = val
         elif cmd == "append":
             templ = tau_core.util.task_template
@@ -119,23 +299,23 @@ async def modify_task(who, id, changes):
                   file=sys.stderr)
             return Error(110, f"unhandled command ({cmd}, {attr}, {val})")
 
-        task["events"].append([cmd, tau_core.util.now(), who, attr, val])
+        events.append([cmd, tau_core.util.now(), who, attr, val])
 
     print("Modified task:")
     print(json.dumps(task, indent=2))
-    plumbing.save_task(task)
+    await task_store.update(task, events)
 
     notify({
             "update": "modify_task",
             "params": [who, id, task, changes]
-        })
+        }, before)
 
 async def change_task_status(who, id, status):
-    blob_idx = plumbing.blob_idx_from_id(id)
-    if blob_idx is None:
+    before = task_store.get(id)
+    if before is None:
         return Error(110, "invalid ID")
-
-    task = plumbing.load_task(blob_idx)
+    # Work on a copy so a failed change leaves the resident task intact
+    task = copy.deepcopy(before)
 
     old_status = task["status"]
     print(f"Changing status for task {id} from {old_status} to {status}")
@@ -156,35 +336,25 @@ async def change_task_status(who, id, status):
     task["status"] = status
 
     # Append to the event log
-    task["events"].append(["status", tau_core.util.now(), who, status])
-
-    plumbing.save_task(task)
+    event = ["status", tau_core.util.now(), who, status]
 
     # If task is stopped then archive it
     if status in ["stop", "cancel"]:
-        active = plumbing.load_active()
-        active[id] = None
-        plumbing.save_active(active)
-        month = util.current_month()
-        archive = plumbing.load_archive(month)
-        archive.append(blob_idx)
-        plumbing.save_archive(month, archive)
+        await task_store.archive(id, task, [event], util.current_month())
+    else:
+        await task_store.update(task, [event])
 
     notify({
             "update": "change_task_status",
             "params": [who, id, task, status]
-        })
+        }, before)
 
 async def add_task_comment(who, id, comment):
-    blob_idx = plumbing.blob_idx_from_id(id)
-    if blob_idx is None:
+    task = task_store.get(id)
+    if task is None:
         return Error(110, "invalid ID")
-
-    task = plumbing.load_task(blob_idx)
-
-    task["events"].append(["comment", tau_core.util.now(), who, comment])
-
-    plumbing.save_task(task)
+    event = ["comment", tau_core.util.now(), who, comment]
+    await task_store.update(task, [event])
 
     notify({
             "update": "add_task_comment",
@@ -193,9 +363,14 @@ async def add_task_comment(who, id, comment):
 
 api_table = {
     "get_info": get_info,
+    "get_stats": get_stats,
     "add_task": add_task,
     "fetch_active_tasks": fetch_active_tasks,
     "fetch_deactive_tasks": fetch_deactive_tasks,
+    "query_tasks": query_tasks,
+    "fetch_changes_since": fetch_changes_since,
+    "search": search,
+    "subscribe": subscribe,
     "fetch_task": fetch_task,
     "fetch_archive_task": fetch_archive_task,
     "modify_task": modify_task,
@@ -217,6 +392,12 @@ async def call(request):
         return result.as_response(request)
 
     # Normal reply
+    if isinstance(result, Stream):
+        result.response = {
+            "id": request["id"],
+            "result": result.result,
+        }
+        return result
     response = {
         "id": request["id"],
         "result": result,
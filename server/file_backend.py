@@ -0,0 +1,257 @@
+import json, os
+
+import tau_core.util
+from tau_core.active_index import ActiveIndex
+from group_commit import GroupCommit
+from pack import Pack, write_pack
+
+# Stores each task's attributes as a JSON blob under blob/<prefix>/<blob_idx>
+# and its events, one JSON line each, under history/<prefix>/<blob_idx>.
+# The active index and archive/<MMYY> lists are kept next to them.
+#
+# Each blob records how many bytes of the history it reflects, so events
+# appended after it are replayed on load. In "log" mode mutations only
+# append to the history and the blob is rewritten as a checkpoint.
+class FileBackend:
+
+    def __init__(self, data_dir, mode, checkpoint_interval, commit_window):
+        self.data_dir = data_dir
+        self.writer = GroupCommit(commit_window)
+        self.mode = mode
+        self.checkpoint_interval = checkpoint_interval
+        # Size of each task's history and the number of events in it
+        # since the last checkpoint. Loading a task updates them too, so
+        # callers keep loads and commits of the same task apart.
+        self.history_sizes = {}
+        self.unapplied = {}
+        # Slot changes stay in memory until the writer flushes the blob
+        # and archive files they refer to
+        self.active = self.open_active()
+        # month -> Pack and blob_idx -> Pack for archived tasks
+        self.packs = {}
+        self.packed = {}
+        self.open_packs()
+
+    def blob_path(self, blob_idx):
+        return f"{self.data_dir}/blob/{blob_idx[:2]}/{blob_idx}"
+
+    def history_path(self, blob_idx):
+        return f"{self.data_dir}/history/{blob_idx[:2]}/{blob_idx}"
+
+    def history_size(self, blob_idx):
+        if (size := self.history_sizes.get(blob_idx)) is None:
+            try:
+                size = len(self.writer.read(self.history_path(blob_idx)))
+            except FileNotFoundError:
+                size = 0
+            self.history_sizes[blob_idx] = size
+        return size
+
+    def save_task(self, task):
+        blob_idx = task["blob_idx"]
+        record = dict(task, history=self.history_size(blob_idx))
+        self.writer.replace(self.blob_path(blob_idx),
+                            json.dumps(record, indent=2))
+        self.unapplied[blob_idx] = 0
+
+    # Replaces any history already stored, so copying a task twice
+    # doesn't repeat its events
+    def add_task(self, task, events):
+        blob_idx = task["blob_idx"]
+        history = "".join(json.dumps(event) + "\n" for event in events)
+        self.writer.replace(self.history_path(blob_idx), history)
+        self.history_sizes[blob_idx] = len(history)
+        self.save_task(task)
+
+    def load_task(self, blob_idx):
+        # Packed tasks are never written again so check those first
+        if (pack := self.packed.get(blob_idx)) is not None:
+            return pack.load(blob_idx)
+        task = json.loads(self.writer.read(self.blob_path(blob_idx)))
+        if "events" in task:
+            return self.upgrade_task(task)
+
+        # Apply any events appended since the blob was written
+        offset = task.pop("history")
+        try:
+            tail = self.writer.read(self.history_path(blob_idx), offset)
+        except FileNotFoundError:
+            tail = ""
+        events = parse_events(tail)
+        for event in events:
+            tau_core.util.apply_event(task, event)
+        self.history_sizes[blob_idx] = offset + len(tail)
+        self.unapplied[blob_idx] = len(events)
+        return task
+
+    def load_events(self, blob_idx):
+        if (pack := self.packed.get(blob_idx)) is not None:
+            return pack.load_events(blob_idx)
+        path = self.history_path(blob_idx)
+        try:
+            return parse_events(self.writer.read(path))
+        except FileNotFoundError:
+            pass
+        # Either nothing happened to the task yet, or it was written by an
+        # older version and loading it moves the events out of the blob
+        self.load_task(blob_idx)
+        try:
+            return parse_events(self.writer.read(path))
+        except FileNotFoundError:
+            return []
+
+    # Moves the events out of a blob written by an older version
+    def upgrade_task(self, task):
+        blob_idx = task["blob_idx"]
+        events = task.pop("events")
+        history = "".join(json.dumps(event) + "\n" for event in events)
+        self.writer.replace(self.history_path(blob_idx), history)
+        self.history_sizes[blob_idx] = len(history)
+        self.save_task(task)
+        return task
+
+    def append_history(self, blob_idx, events):
+        records = "".join(json.dumps(event) + "\n" for event in events)
+        self.writer.append(self.history_path(blob_idx), records)
+        self.history_sizes[blob_idx] = \
+            self.history_size(blob_idx) + len(records)
+        self.unapplied[blob_idx] = \
+            self.unapplied.get(blob_idx, 0) + len(events)
+
+    def checkpoint(self, task):
+        self.save_task(task)
+
+    def commit_task(self, task, events):
+        blob_idx = task["blob_idx"]
+        self.append_history(blob_idx, events)
+        if (self.mode != "log" or
+                self.unapplied[blob_idx] >= self.checkpoint_interval):
+            self.save_task(task)
+
+    def open_active(self):
+        active = ActiveIndex(f"{self.data_dir}/active.idx")
+        # Convert the JSON list used by older versions
+        old_path = f"{self.data_dir}/active"
+        if os.path.exists(old_path):
+            with open(old_path, "r") as f:
+                active.reset(json.load(f))
+            active.sync()
+            os.remove(old_path)
+        return active
+
+    def save_active(self, active):
+        self.active.reset(active)
+        self.writer.touch(self.active)
+
+    def load_active(self):
+        return self.active.to_list()
+
+    def allocate_id(self, blob_idx):
+        id = self.active.allocate(blob_idx)
+        self.writer.touch(self.active)
+        return id
+
+    def release_id(self, id):
+        self.active.release(id)
+        self.writer.touch(self.active)
+
+    def save_changes(self, changes):
+        self.writer.replace(f"{self.data_dir}/changes", json.dumps(changes))
+
+    def load_changes(self):
+        try:
+            return json.loads(self.writer.read(f"{self.data_dir}/changes"))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_archive(self, month, archive):
+        self.writer.replace(f"{self.data_dir}/archive/{month}",
+                            json.dumps(archive, indent=2))
+
+    def load_archive(self, month):
+        try:
+            return json.loads(
+                self.writer.read(f"{self.data_dir}/archive/{month}"))
+        except FileNotFoundError:
+            return []
+
+    def pack_path(self, month):
+        return f"{self.data_dir}/pack/{month}.pack"
+
+    def open_packs(self):
+        try:
+            filenames = os.listdir(f"{self.data_dir}/pack")
+        except FileNotFoundError:
+            return
+        for filename in filenames:
+            if filename.endswith(".pack"):
+                self.add_pack(filename[:-len(".pack")])
+
+    def add_pack(self, month):
+        pack = Pack(self.pack_path(month))
+        if (old_pack := self.packs.get(month)) is not None:
+            old_pack.close()
+        self.packs[month] = pack
+        for blob_idx in pack.index:
+            self.packed[blob_idx] = pack
+
+    # Moves the month's archived tasks out of the blob tree into one pack.
+    # Returns the number of tasks that were newly packed.
+    def repack(self, month):
+        archive = [blob_idx for blob_idx in self.load_archive(month)
+                   if blob_idx is not None]
+        loose = [blob_idx for blob_idx in archive
+                 if blob_idx not in self.packed]
+        if not loose:
+            return 0
+
+        # Loading folds in any events appended since the last checkpoint
+        tasks = [(self.load_task(blob_idx), self.load_events(blob_idx))
+                 for blob_idx in archive]
+        write_pack(self.pack_path(month), tasks)
+        self.add_pack(month)
+
+        for blob_idx in loose:
+            self.writer.remove(self.blob_path(blob_idx))
+            self.writer.remove(self.history_path(blob_idx))
+            self.history_sizes.pop(blob_idx, None)
+            self.unapplied.pop(blob_idx, None)
+        return len(loose)
+
+    # Writes out anything still buffered by the group commit
+    def flush(self):
+        self.writer.flush()
+
+    def flushed(self):
+        return self.writer.flushed()
+
+    def archive_months(self):
+        self.flush()
+        try:
+            months = os.listdir(f"{self.data_dir}/archive")
+        except FileNotFoundError:
+            return []
+        return sorted(month for month in months if not month.endswith(".tmp"))
+
+    # Every blob in the tree, including ones no longer referenced
+    def all_blob_idxs(self):
+        self.flush()
+        blob_dir = f"{self.data_dir}/blob"
+        try:
+            prefixes = os.listdir(blob_dir)
+        except FileNotFoundError:
+            prefixes = []
+        loose = [blob_idx for prefix in prefixes
+                 for blob_idx in os.listdir(f"{blob_dir}/{prefix}")
+                 if not blob_idx.endswith(".tmp")]
+        return sorted(set(loose) | set(self.packed))
+
+# Parses history lines, skipping any torn by a crash mid-write
+def parse_events(history):
+    events = []
+    for line in history.splitlines():
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            continue
+    return events
@@ -0,0 +1,148 @@
+import concurrent.futures, os, threading, traceback
+
+from util import fsync_dir
+
+# Buffers file writes for up to `window` seconds so that changes arriving
+# together are flushed in one batch, and repeated writes to the same file
+# inside the window collapse into a single write. Whole files are replaced
+# atomically by writing a temp file and renaming it over the target, so
+# readers never see a truncated file. A window of 0 flushes every write
+# immediately.
+#
+# Writers must not acknowledge a change until flushed() says it reached
+# the disk. Writes that fail stay pending and are tried again with the
+# next flush, so appends are never written twice nor dropped.
+class GroupCommit:
+
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.RLock()
+        # path -> ("replace", data) | ("append", data) | ("remove", None)
+        self.pending = {}
+        # Objects buffering their own changes until sync() on flush
+        self.dirty = set()
+        # Directories whose renames and removals weren't synced yet
+        self.dirs = set()
+        # Completed by the flush which writes what is pending now, or
+        # failed with the error that stopped it
+        self.batch = concurrent.futures.Future()
+        self.timer = None
+
+    def replace(self, path, data):
+        with self.lock:
+            self.pending[path] = ("replace", data)
+            self.schedule()
+
+    def append(self, path, data):
+        with self.lock:
+            op, old = self.pending.get(path, ("append", ""))
+            if op == "remove":
+                op, old = "replace", ""
+            self.pending[path] = (op, old + data)
+            self.schedule()
+
+    def remove(self, path):
+        with self.lock:
+            self.pending[path] = ("remove", None)
+            self.schedule()
+
+    def touch(self, obj):
+        with self.lock:
+            self.dirty.add(obj)
+            self.schedule()
+
+    # Reads a file, from offset onwards, as it will be once pending
+    # writes are flushed. Offsets are in bytes so files must be ASCII.
+    def read(self, path, offset=0):
+        with self.lock:
+            op, data = self.pending.get(path, (None, None))
+            if op == "replace":
+                return data[offset:]
+            if op == "remove":
+                raise FileNotFoundError(path)
+            try:
+                with open(path, "r") as f:
+                    size = f.seek(0, os.SEEK_END)
+                    f.seek(min(offset, size))
+                    contents = f.read()
+            except FileNotFoundError:
+                if op is None:
+                    raise
+                size, contents = 0, ""
+            if op == "append":
+                contents += data[max(offset - size, 0):]
+            return contents
+
+    # Returns a future for the flush of everything written so far, or
+    # None when it is already on disk
+    def flushed(self):
+        with self.lock:
+            if not (self.pending or self.dirty or self.dirs):
+                return None
+            return self.batch
+
+    def schedule(self):
+        if self.window <= 0:
+            self.flush()
+        elif self.timer is None:
+            self.timer = threading.Timer(self.window, self.flush_later)
+            self.timer.daemon = True
+            self.timer.start()
+
+    # Runs on the timer thread, where an error only reaches the writers
+    # through their batch. The writes left pending are tried again.
+    def flush_later(self):
+        try:
+            self.flush()
+        except Exception:
+            traceback.print_exc()
+            with self.lock:
+                self.schedule()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            batch, self.batch = self.batch, concurrent.futures.Future()
+            try:
+                self.write_pending()
+            except BaseException as e:
+                batch.set_exception(e)
+                raise
+            batch.set_result(None)
+
+    # Each write is only dropped from pending once it succeeded, so after
+    # an error the rest is written by the next flush. Objects modified in
+    # place go last since they refer to the files, like an index slot
+    # naming a blob, and must not reach the disk before them.
+    def write_pending(self):
+        for path, (op, data) in list(self.pending.items()):
+            dirname = os.path.dirname(path)
+            os.makedirs(dirname, exist_ok=True)
+            if op == "replace":
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            elif op == "append":
+                with open(path, "a") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            del self.pending[path]
+            self.dirs.add(dirname)
+        # Make the renames and removals durable, once per directory
+        for dirname in list(self.dirs):
+            fsync_dir(dirname)
+            self.dirs.discard(dirname)
+        for obj in list(self.dirty):
+            obj.sync()
+            self.dirty.discard(obj)
@@ -0,0 +1,44 @@
+import asyncio, concurrent.futures, threading
+
+# Runs blocking storage calls on a bounded pool of threads so the event
+# loop only does networking and dispatch. Keeps counters on how many
+# calls are waiting for a thread, to tell when the pool is too small.
+class IOPool:
+
+    def __init__(self, size):
+        self.size = size
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=size, thread_name_prefix="storage")
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.completed = 0
+
+    async def run(self, func, *args):
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.call, func, args)
+
+    def call(self, func, args):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": self.size,
+                "queued": self.queued,
+                "running": self.running,
+                "max_queued": self.max_queued,
+                "completed": self.completed,
+            }
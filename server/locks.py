@@ -0,0 +1,66 @@
+import asyncio, contextlib, time
+
+# Hands out asyncio locks by key, such as ("task", blob_idx), ("active",)
+# or ("archive", month), so mutations touching different tasks run
+# concurrently and only conflicting read-modify-write sequences wait.
+# Locks are created on demand and dropped once nobody holds or waits
+# on them. Contention is counted per kind of key for tuning.
+class LockManager:
+
+    def __init__(self):
+        # key -> [lock, number of holders and waiters]
+        self.locks = {}
+        # kind -> {"acquired": n, "contended": n, "wait_time": seconds}
+        self.counters = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys):
+        # Always acquire in the same order to avoid deadlocks
+        keys = sorted(set(keys))
+        acquired = []
+        try:
+            for key in keys:
+                await self.acquire(key)
+                acquired.append(key)
+            yield
+        finally:
+            for key in reversed(acquired):
+                self.release(key)
+
+    async def acquire(self, key):
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        counters = self.counters.setdefault(
+            key[0], {"acquired": 0, "contended": 0, "wait_time": 0.0})
+        counters["acquired"] += 1
+
+        lock = entry[0]
+        if not lock.locked():
+            await lock.acquire()
+            return
+
+        counters["contended"] += 1
+        start = time.monotonic()
+        try:
+            await lock.acquire()
+        except BaseException:
+            self.drop(key)
+            raise
+        finally:
+            counters["wait_time"] += time.monotonic() - start
+
+    def release(self, key):
+        self.locks[key][0].release()
+        self.drop(key)
+
+    def drop(self, key):
+        entry = self.locks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.locks[key]
+
+    def stats(self):
+        return {
+            "held": len(self.locks),
+            "by_kind": self.counters,
+        }
@@ -1,8 +1,37 @@
 #!/usr/bin/env python3
 """tau2 server - Task management RPC server"""
-import asyncio
+import asyncio, signal, traceback
 from tau_core.rpc_server import run_rpc_server
 import api
 
+# Seconds between checks for archive months that can be packed
+REPACK_INTERVAL = 60 * 60
+
+async def repack_periodically():
+    while True:
+        try:
+            await api.task_store.repack_cold_archives()
+        except Exception:
+            traceback.print_exc()
+        await asyncio.sleep(REPACK_INTERVAL)
+
+async def main():
+    # Stop on SIGTERM like on Ctrl-C, so what is kept in memory is saved
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel)
+    repack_task = asyncio.create_task(repack_periodically())
+    try:
+        await run_rpc_server("0.0.0.0", 7643, api.call)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        # Don't leave a repack running while the server shuts down
+        repack_task.cancel()
+
 if __name__ == "__main__":
-    asyncio.run(run_rpc_server("0.0.0.0", 7643, api.call))
+    api.task_store.load()
+    try:
+        asyncio.run(main())
+    finally:
+        api.task_store.close()
+        api.event_log.close()
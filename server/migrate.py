@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Copy the tau2 server data between storage backends.
+
+Usage: python server/migrate.py [SOURCE] [DEST]
+
+SOURCE and DEST default to "files" and "sqlite". Stop the server
+first, then set storage_backend in tau.toml to DEST once done. Tasks
+already in DEST are replaced, so an interrupted migration can simply
+be run again.
+"""
+import sys
+
+import plumbing
+
+def migrate(source, dest):
+    print(f"Migrating {source} -> {dest}")
+    src = plumbing.open_backend(source)
+    dst = plumbing.open_backend(dest)
+
+    count = 0
+    for blob_idx in src.all_blob_idxs():
+        # Loading replays the history so the copy is a checkpoint
+        dst.add_task(src.load_task(blob_idx), src.load_events(blob_idx))
+        count += 1
+    print(f"Copied {count} tasks")
+
+    dst.save_active(src.load_active())
+    for month in src.archive_months():
+        dst.save_archive(month, src.load_archive(month))
+        print(f"Copied archive {month}")
+
+    # The change numbers clients sync from, and the search index they
+    # tell to be current. The index itself is shared by the backends.
+    if (changes := src.load_changes()) is not None:
+        dst.save_changes(changes)
+
+    # Loading can upgrade tasks in the source too
+    src.flush()
+    dst.flush()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3 or (len(sys.argv) > 1 and sys.argv[1] in ["-h", "--help"]):
+        print(__doc__)
+        sys.exit(-1)
+    source = sys.argv[1] if len(sys.argv) > 1 else "files"
+    dest = sys.argv[2] if len(sys.argv) > 2 else "sqlite"
+    migrate(source, dest)
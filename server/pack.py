@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Pack archived task blobs into one file per month.
+
+Usage: python server/pack.py [MMYY...]
+
+Without arguments every archive month except the current one is packed.
+This can be run while the server is stopped; the server also repacks
+cold months by itself in the background.
+"""
+import json, mmap, os, struct, sys, zlib
+
+from util import fsync_dir
+
+# A pack is MAGIC, then each task's attributes and its events as two zlib
+# compressed JSON documents, then an index mapping blob_idx ->
+# [offset, length, events offset, events length] and finally a fixed size
+# footer pointing at the index.
+MAGIC = b"TAUP"
+# index offset, index length, magic
+FOOTER = struct.Struct("<QQ4s")
+
+# Writes a list of (task, events) pairs
+def write_pack(path, tasks):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    index = {}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        for task, events in tasks:
+            entry = index[task["blob_idx"]] = []
+            for obj in [task, events]:
+                data = zlib.compress(json.dumps(obj).encode())
+                entry += [f.tell(), len(data)]
+                f.write(data)
+        index_data = zlib.compress(json.dumps(index).encode())
+        offset = f.tell()
+        f.write(index_data)
+        f.write(FOOTER.pack(offset, len(index_data), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(path))
+
+class Pack:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length, magic = FOOTER.unpack_from(
+            self.mm, len(self.mm) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a pack")
+        with memoryview(self.mm)[offset:offset + length] as view:
+            self.index = json.loads(zlib.decompress(view))
+
+    def __contains__(self, blob_idx):
+        return blob_idx in self.index
+
+    # Decompresses straight out of the mapping without copying it first
+    def read(self, offset, length):
+        with memoryview(self.mm)[offset:offset + length] as view:
+            return json.loads(zlib.decompress(view))
+
+    def load(self, blob_idx):
+        return self.read(*self.index[blob_idx][:2])
+
+    def load_events(self, blob_idx):
+        return self.read(*self.index[blob_idx][2:])
+
+    def close(self):
+        self.mm.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ["-h", "--help"]:
+        print(__doc__)
+        sys.exit(-1)
+
+    import plumbing
+    if len(sys.argv) > 1:
+        for month in sys.argv[1:]:
+            plumbing.repack(month)
+    else:
+        plumbing.repack_cold_archives()
+    plumbing.flush()
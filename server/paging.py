@@ -0,0 +1,24 @@
+import base64, json
+
+# Largest page of tasks a client can ask for
+MAX_PAGE_SIZE = 1000
+
+def is_valid_page_size(page_size):
+    return isinstance(page_size, int) and 0 < page_size <= MAX_PAGE_SIZE
+
+# Cursors are handed to clients as opaque strings holding what was
+# being listed and the position of the last row sent. Positions are
+# IDs, archive positions or sort keys rather than offsets, so tasks
+# added or removed meanwhile don't shift the following pages.
+def encode_cursor(kind, state):
+    data = json.dumps([kind, state]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+def decode_cursor(cursor, kind):
+    try:
+        cursor_kind, state = json.loads(base64.urlsafe_b64decode(cursor))
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+    if cursor_kind != kind:
+        raise ValueError("invalid cursor")
+    return state
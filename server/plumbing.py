@@ -1,66 +1,154 @@
-import json
-from util import config_path, safe_open
+import tau_core.config
+from util import config_path, current_month
 
-def save_task(task):
-    blob_idx = task["blob_idx"]
-    blob_prefix = blob_idx[:2]
+# Where tasks are stored. "files" keeps the data/blob tree of JSON files,
+# "sqlite" keeps everything in data/tau.db. Use migrate.py to convert.
+STORAGE_BACKEND = tau_core.config.get_str("storage_backend", "files")
+# "blob" rewrites the whole task on every change. "log" appends each
+# event to a per task log and only rewrites the blob as a checkpoint.
+STORAGE_MODE = tau_core.config.get_str("storage_mode", "blob")
+CHECKPOINT_INTERVAL = tau_core.config.get_int("checkpoint_interval", 64)
+# Seconds to buffer writes so changes arriving together share a flush.
+# 0 flushes every change immediately.
+COMMIT_WINDOW = tau_core.config.get_float("commit_window", 0)
 
-    with safe_open(
-        f"{config_path()}/data/blob/{blob_prefix}/{blob_idx}", "w"
-    ) as f:
-        json.dump(task, f, indent=2)
+def open_backend(name):
+    data_dir = f"{config_path()}/data"
+    if name == "files":
+        from file_backend import FileBackend
+        return FileBackend(data_dir, STORAGE_MODE, CHECKPOINT_INTERVAL,
+                           COMMIT_WINDOW)
+    elif name == "sqlite":
+        from sqlite_backend import SqliteBackend
+        return SqliteBackend(f"{data_dir}/tau.db",
+                             STORAGE_MODE, CHECKPOINT_INTERVAL)
+    raise ValueError(f"unknown storage backend '{name}'")
+
+opened = None
+
+# The configured backend, opened on first use so that importing this
+# doesn't open it for tools which open their own, like migrate.py
+def backend():
+    global opened
+    if opened is None:
+        opened = open_backend(STORAGE_BACKEND)
+    return opened
+
+# Tasks are stored without their events, which are appended to a
+# separate history and only loaded on request.
+def add_task(task, events):
+    backend().add_task(task, events)
 
 def load_task(blob_idx):
-    blob_prefix = blob_idx[:2]
-    with safe_open(
-        f"{config_path()}/data/blob/{blob_prefix}/{blob_idx}", "r"
-    ) as f:
-        return json.load(f)
+    return backend().load_task(blob_idx)
+
+def load_events(blob_idx):
+    return backend().load_events(blob_idx)
+
+# Appends the task's new events to its history and persists the task
+def commit_task(task, events):
+    backend().commit_task(task, events)
+
+# Rewrites the stored task so no history needs replaying on load
+def checkpoint(task):
+    backend().checkpoint(task)
+
+# Writes out any changes still buffered by the group commit
+def flush():
+    backend().flush()
+
+# Returns a concurrent.futures.Future completed once the changes made so
+# far are on disk, or None if they already are
+def flushed():
+    return backend().flushed()
 
 def save_active(active):
-    with safe_open(f"{config_path()}/data/active", "w") as f:
-        json.dump(active, f, indent=2)
+    backend().save_active(active)
 
 def load_active():
-    try:
-        with safe_open(f"{config_path()}/data/active", "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
-
-# Gives the task an ID. Either reuse next free slot or append to the end
-def next_free_id(active, blob_idx):
-    for i, other_idx in enumerate(active):
-        if other_idx is None:
-            active[i] = blob_idx
-            return i
-    # No free slot found so just append
-    active.append(blob_idx)
-    return len(active) - 1
+    return backend().load_active()
+
+# Gives the task an ID. Either reuses a free slot or appends to the end
+def allocate_id(blob_idx):
+    return backend().allocate_id(blob_idx)
+
+# Frees the task's ID for reuse
+def release_id(id):
+    backend().release_id(id)
+
+# The sequence numbers of the changes to the active list, see TaskStore.
+# None if they were never saved.
+def save_changes(changes):
+    backend().save_changes(changes)
+
+def load_changes():
+    return backend().load_changes()
 
 def save_archive(month, archive):
-    with safe_open(f"{config_path()}/data/archive/{month}", "w") as f:
-        json.dump(archive, f, indent=2)
+    backend().save_archive(month, archive)
 
 def load_archive(month):
-    try:
-        with safe_open(f"{config_path()}/data/archive/{month}", "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
+    return backend().load_archive(month)
 
-# Finds the blob's index from its active ID
-def blob_idx_from_id(id):
-    active = load_active()
+# Moves a stopped task from the active index to the month's archive.
+# Returns its position in the archive.
+# The ID is released last so a crash in between leaves the task listed
+# twice rather than in neither list.
+def archive_task(id, task, month):
+    # Archived tasks are cold so fold their log into the blob
+    if STORAGE_MODE == "log":
+        checkpoint(task)
+    archive = load_archive(month)
+    archive.append(task["blob_idx"])
+    save_archive(month, archive)
+    release_id(id)
+    return len(archive) - 1
 
+def load_archive_tasks(month):
+    tasks = []
+    for blob_idx in load_archive(month):
+        if blob_idx is None:
+            tasks.append(None)
+            continue
+        tasks.append(load_task(blob_idx))
+    return tasks
+
+# Loads up to count archived tasks following position after,
+# as (position, task) pairs
+def load_archive_page(month, after, count):
+    archive = load_archive(month)
+    rows = []
+    for pos in range(max(after + 1, 0), len(archive)):
+        if len(rows) == count:
+            break
+        if archive[pos] is not None:
+            rows.append((pos, load_task(archive[pos])))
+    return rows
+
+# Loads the task along with its events
+def load_archive_task(id, month):
+    archive = load_archive(month)
     try:
-        active[id]
+        blob_idx = archive[id]
     except IndexError:
         return None
-
-    blob_idx = active[id]
     if blob_idx is None:
         return None
+    task = load_task(blob_idx)
+    task["events"] = load_events(blob_idx)
+    return task
+
+# Packs an archive month's tasks into a single file
+def repack(month):
+    if (count := backend().repack(month)) > 0:
+        print(f"Packed {count} tasks from archive {month}")
+    return count
 
-    return blob_idx
+def archive_months():
+    return backend().archive_months()
 
+# Packs every archive month that is no longer being appended to
+def repack_cold_archives():
+    for month in backend().archive_months():
+        if month != current_month():
+            repack(month)
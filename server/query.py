@@ -0,0 +1,358 @@
+import functools
+from datetime import datetime
+
+import tau_core.util
+import task_index
+
+# Compiles the filter arguments of `tau show` into a tree of nodes which
+# can both test a single task and look up candidates in a TaskIndex.
+#
+#   +tag  @user             task is tagged / assigned
+#   project:ops             project starts with ops
+#   status:open             status is one of open, start or pause
+#   title:foo  desc:foo     attribute equals the value
+#   due:0312  rank:1.5      attribute equals the value
+#   due:0312..0512          inclusive range, either end may be left out
+#   rank:1..  rank:..2.5
+#   project:none            attribute is unset, also for rank and due
+#
+# Terms next to each other must all match. They can be combined with
+# "and", "or" and "not" and grouped with parentheses. NOT binds tighter
+# than AND, which binds tighter than OR.
+
+class QueryError(Exception):
+    pass
+
+# Attributes the results can be sorted on
+SORTABLE = ["title", "status", "project", "rank", "due", "created"]
+
+# A single filter term. lookup(index) returns the set of matching IDs,
+# or None when the attribute isn't indexed and tasks must be tested.
+class Term:
+
+    def __init__(self, match, lookup=None):
+        self.match = match
+        self.lookup_ids = lookup
+
+    # Returns (ids, exact) where ids holds every matching task, and
+    # exact says whether it holds nothing else. None if it can't tell.
+    def lookup(self, index):
+        if self.lookup_ids is None:
+            return None
+        return self.lookup_ids(index), True
+
+class All:
+
+    def match(self, task):
+        return True
+
+    def lookup(self, index):
+        return index.ids, True
+
+class And:
+
+    def __init__(self, terms):
+        self.terms = terms
+
+    def match(self, task):
+        return all(term.match(task) for term in self.terms)
+
+    def lookup(self, index):
+        found = [result for term in self.terms
+                 if (result := term.lookup(index)) is not None]
+        if not found:
+            return None
+        found.sort(key=lambda result: len(result[0]))
+        ids = found[0][0].intersection(*[ids for ids, _ in found[1:]])
+        exact = (len(found) == len(self.terms)
+                 and all(exact for _, exact in found))
+        return ids, exact
+
+class Or:
+
+    def __init__(self, terms):
+        self.terms = terms
+
+    def match(self, task):
+        return any(term.match(task) for term in self.terms)
+
+    def lookup(self, index):
+        found = [term.lookup(index) for term in self.terms]
+        if None in found:
+            return None
+        ids = set().union(*[ids for ids, _ in found])
+        return ids, all(exact for _, exact in found)
+
+class Not:
+
+    def __init__(self, term):
+        self.term = term
+
+    def match(self, task):
+        return not self.term.match(task)
+
+    def lookup(self, index):
+        found = self.term.lookup(index)
+        # The complement of a superset would miss tasks
+        if found is None or not found[1]:
+            return None
+        return index.ids - found[0], True
+
+# The same queries tend to arrive over and over, from the CLI and bots.
+# Dates without a year are in the current one, so it is part of the key.
+@functools.lru_cache(maxsize=128)
+def compile_cached(tokens, year):
+    parser = Parser(tokenize(tokens))
+    if not parser.tokens:
+        return All()
+    query = parser.parse_or()
+    if parser.tokens:
+        raise QueryError(f"unexpected '{parser.tokens[0]}'")
+    return query
+
+def compile_filter(filters):
+    return compile_cached(tuple(filters), datetime.now().year)
+
+# Splits parentheses off the shell arguments so "(+a" works like "( +a"
+def tokenize(filters):
+    tokens = []
+    for fltr in filters:
+        if not isinstance(fltr, str):
+            raise QueryError(f"filter must be a string, got {fltr!r}")
+        closing = 0
+        while fltr.startswith("("):
+            tokens.append("(")
+            fltr = fltr[1:]
+        while fltr.endswith(")"):
+            closing += 1
+            fltr = fltr[:-1]
+        if fltr:
+            tokens.append(fltr)
+        tokens.extend([")"] * closing)
+    return tokens
+
+class Parser:
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def peek(self):
+        return self.tokens[0].lower() if self.tokens else None
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() == "or":
+            self.tokens.pop(0)
+            terms.append(self.parse_and())
+        return terms[0] if len(terms) == 1 else Or(terms)
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.peek() not in [None, "or", ")"]:
+            if self.peek() == "and":
+                self.tokens.pop(0)
+            terms.append(self.parse_not())
+        return terms[0] if len(terms) == 1 else And(terms)
+
+    def parse_not(self):
+        if self.peek() == "not":
+            self.tokens.pop(0)
+            return Not(self.parse_not())
+        return self.parse_term()
+
+    def parse_term(self):
+        if not self.tokens:
+            raise QueryError("filter ends unexpectedly")
+        token = self.tokens.pop(0)
+        if token == "(":
+            query = self.parse_or()
+            if self.peek() != ")":
+                raise QueryError("missing ')'")
+            self.tokens.pop(0)
+            return query
+        if token == ")" or token.lower() in ["and", "or"]:
+            raise QueryError(f"unexpected '{token}'")
+        return compile_term(token)
+
+def compile_term(fltr):
+    if fltr.startswith("+"):
+        tag = fltr[1:]
+        return Term(lambda task: tag in task["tags"],
+                    lambda index: index.with_tag(tag))
+    elif fltr.startswith("@"):
+        assign = fltr[1:]
+        return Term(lambda task: assign in task["assigned"],
+                    lambda index: index.with_assigned(assign))
+    elif ":" not in fltr:
+        raise QueryError(f"unknown arg '{fltr}'")
+
+    attr, val = fltr.split(":", 1)
+    if val.lower() == "none":
+        if attr not in ["project", "rank", "due"]:
+            raise QueryError(f"cannot filter {attr} by none")
+        return Term(lambda task: task[attr] is None,
+                    lambda index: index.with_unset(attr))
+    elif attr == "status":
+        if val not in ["open", "start", "pause"]:
+            raise QueryError(
+                'filter by status can only be ["open", "start", "pause"]')
+        return Term(lambda task: task["status"] == val,
+                    lambda index: index.with_status(val))
+    elif attr == "project":
+        return Term(lambda task: (task["project"] is not None
+                                  and task["project"].startswith(val)),
+                    lambda index: index.with_project_prefix(val))
+    elif attr in ["due", "rank"]:
+        if ".." in val:
+            low, high = val.split("..", 1)
+            low = convert_value(attr, low) if low else None
+            high = convert_value(attr, high) if high else None
+        else:
+            low = high = convert_value(attr, val)
+        def in_range(task):
+            value = task[attr]
+            if value is None:
+                return False
+            return ((low is None or value >= low)
+                    and (high is None or value <= high))
+        return Term(in_range,
+                    lambda index: index.with_range(attr, low, high))
+    elif attr in ["title", "desc"]:
+        return Term(lambda task: task[attr] == val)
+    else:
+        raise QueryError(f"unhandled attr '{attr}' = {val}")
+
+# Parses values the same way the client does when setting them
+def convert_value(attr, val):
+    if attr == "rank":
+        try:
+            return float(val)
+        except ValueError:
+            raise QueryError(f"rank value {val} isn't convertable to float")
+    elif attr == "due":
+        year = int(datetime.now().strftime("%Y")) % 100
+        try:
+            if len(val) != 4:
+                raise ValueError
+            dt = datetime.strptime(f"18:00 {val}{year}", "%H:%M %d%m%y")
+        except ValueError:
+            raise QueryError(f"unknown date format {val}")
+        return tau_core.util.datetime_to_unix(dt)
+    return val
+
+# Returns (id, task) pairs of the tasks matching the query. Candidates
+# come from the index where possible and are only tested one by one
+# when it can't answer the query exactly. sort is an attribute to
+# order by, descending when prefixed with "-". Tasks where it's unset
+# always come last, and ties are ordered by ID. after is the position()
+# of a row from an earlier page to continue from. get(id) returns the task.
+def select(query, index, get, sort=None, limit=None, after=None):
+    found = query.lookup(index)
+    if found is None:
+        candidates, exact = index.ids, False
+    else:
+        candidates, exact = found
+
+    def matches(id):
+        return exact or query.match(get(id))
+
+    if sort is None:
+        start = -1 if after is None else after[0]
+        ids = [id for id in sorted(candidates) if id > start and matches(id)]
+        if limit is not None:
+            ids = ids[:limit]
+        return [(id, get(id)) for id in ids]
+
+    reverse = sort.startswith("-")
+    attr = sort.lstrip("-")
+    if attr not in SORTABLE:
+        raise QueryError(f"cannot sort by '{attr}'")
+
+    # Walk the ordered index for the top few of many candidates,
+    # otherwise sorting the candidates is cheaper
+    if (attr in task_index.ORDERED and limit is not None
+            and len(candidates) > limit):
+        ids = []
+        if after is None or not after[0]:
+            start = None if after is None else tuple(after[1:])
+            for id in index.walk(attr, reverse, start):
+                if len(ids) == limit:
+                    break
+                if id in candidates and matches(id):
+                    ids.append(id)
+        start = after[2] if after is not None and after[0] else -1
+        for id in sorted(index.with_unset(attr)):
+            if len(ids) == limit:
+                break
+            if id > start and id in candidates and matches(id):
+                ids.append(id)
+        return [(id, get(id)) for id in ids]
+
+    rows = [(id, get(id)) for id in candidates if matches(id)]
+    if after is not None:
+        rows = [row for row in rows if is_after(row, attr, reverse, after)]
+    rows = sort_rows(rows, attr, reverse)
+    if limit is not None:
+        rows = rows[:limit]
+    return rows
+
+# Tasks written by other clients may hold any JSON value, so values of
+# different types are ordered apart rather than compared
+def sort_key(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (0, value)
+    if isinstance(value, str):
+        return (1, value)
+    return (2, repr(value))
+
+def sort_rows(rows, attr, reverse):
+    present = [row for row in rows if row[1].get(attr) is not None]
+    missing = [row for row in rows if row[1].get(attr) is None]
+    present.sort(key=lambda row: (sort_key(row[1][attr]), row[0]),
+                 reverse=reverse)
+    missing.sort(key=lambda row: row[0])
+    return present + missing
+
+# Where a row is in the order select() returns them, for continuing
+# after it. The attribute being unset comes first since those tasks are
+# listed last.
+def position(row, sort):
+    id, task = row
+    if sort is None:
+        return [id]
+    value = task.get(sort.lstrip("-"))
+    return [value is None, value, id]
+
+# Makes sure a position coming back from a client can be compared
+def check_position(position, sort):
+    if not isinstance(position, list):
+        raise QueryError("invalid cursor")
+    if sort is None:
+        if len(position) != 1 or not isinstance(position[0], int):
+            raise QueryError("invalid cursor")
+        return
+    if (len(position) != 3 or not isinstance(position[0], bool)
+            or not isinstance(position[2], int)):
+        raise QueryError("invalid cursor")
+    missing, value = position[0], position[1]
+    attr = sort.lstrip("-")
+    if missing:
+        valid = value is None
+    elif attr in ["title", "status", "project"]:
+        valid = isinstance(value, str)
+    else:
+        valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+    if not valid:
+        raise QueryError("invalid cursor")
+
+def is_after(row, attr, reverse, after):
+    id, task = row
+    missing, value, after_id = after
+    if (task.get(attr) is None) != missing:
+        return not missing
+    if missing:
+        return id > after_id
+    key = (sort_key(task[attr]), id)
+    if reverse:
+        return key < (sort_key(value), after_id)
+    return key > (sort_key(value), after_id)
@@ -0,0 +1,182 @@
+import json, math, os, re
+
+from util import fsync_dir
+
+# Matches count this much more in the title than elsewhere
+FIELD_WEIGHTS = {"title": 3, "desc": 1, "comments": 1}
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower()) if text else []
+
+def count_terms(text):
+    counts = {}
+    for term in tokenize(text):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+# Inverted index over the title, description and comments of every
+# task, active and archived, for ranked full-text search.
+#
+# Each document keeps the term counts per field so a changed title or
+# description can be taken out again, while comments only accumulate.
+# Kept in memory and written to data/search/snapshot when the server
+# stops, so a clean restart doesn't tokenize the tasks again. Every
+# change numbers the index with the next seq, which the store saves
+# with it to tell whether the snapshot is current, and the index is
+# rebuilt from the tasks when it may not be.
+class SearchIndex:
+
+    def __init__(self, path):
+        self.path = path
+        # blob_idx -> {"fields": {field: {term: n}}, "where": where}
+        # where is None for active tasks or [month, pos] once archived.
+        self.docs = {}
+        # term -> {blob_idx: weighted count}
+        self.postings = {}
+        # blob_idx -> weighted number of terms
+        self.lengths = {}
+        self.total_length = 0
+        self.seq = 0
+
+    def snapshot_path(self):
+        return f"{self.path}/snapshot"
+
+    # Returns False if there is no index on disk and it must be built
+    def load(self):
+        try:
+            with open(self.snapshot_path(), "r") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return False
+        self.seq = snapshot["seq"]
+        for blob_idx, doc in snapshot["docs"].items():
+            self.docs[blob_idx] = {"fields": {}, "where": doc["where"]}
+            for field, counts in doc["fields"].items():
+                self.set_counts(blob_idx, field, counts)
+        return True
+
+    # Indexes a task from scratch, such as when building the index
+    def add(self, task, events, where=None):
+        blob_idx = task["blob_idx"]
+        self.record(["add", blob_idx, where])
+        for field in ["title", "desc"]:
+            self.record(["set", blob_idx, field, count_terms(task[field])])
+        self.update(blob_idx, events)
+
+    # Indexes the text changed by a task's new events
+    def update(self, blob_idx, events):
+        comments = {}
+        for event in events:
+            if event[0] == "set" and event[3] in ["title", "desc"]:
+                self.record(["set", blob_idx, event[3],
+                             count_terms(event[4])])
+            elif event[0] == "comment":
+                for term, n in count_terms(event[3]).items():
+                    comments[term] = comments.get(term, 0) + n
+        if comments:
+            self.record(["comment", blob_idx, comments])
+
+    def move(self, blob_idx, where):
+        self.record(["move", blob_idx, where])
+
+    def record(self, entry):
+        self.apply(entry)
+        self.seq += 1
+
+    def apply(self, entry):
+        op, blob_idx = entry[0], entry[1]
+        if op == "add":
+            self.remove(blob_idx)
+            self.docs[blob_idx] = {"fields": {}, "where": entry[2]}
+            return
+        if (doc := self.docs.get(blob_idx)) is None:
+            return
+        if op == "set":
+            self.set_counts(blob_idx, entry[2], entry[3])
+        elif op == "comment":
+            comments = dict(doc["fields"].get("comments", {}))
+            for term, n in entry[2].items():
+                comments[term] = comments.get(term, 0) + n
+            self.set_counts(blob_idx, "comments", comments)
+        elif op == "move":
+            doc["where"] = entry[2]
+
+    def set_counts(self, blob_idx, field, counts):
+        fields = self.docs[blob_idx]["fields"]
+        weight = FIELD_WEIGHTS[field]
+        for term, n in fields.get(field, {}).items():
+            self.add_posting(blob_idx, term, -n * weight)
+        fields[field] = counts
+        for term, n in counts.items():
+            self.add_posting(blob_idx, term, n * weight)
+
+    def add_posting(self, blob_idx, term, delta):
+        postings = self.postings.setdefault(term, {})
+        count = postings.get(blob_idx, 0) + delta
+        if count > 0:
+            postings[blob_idx] = count
+        else:
+            postings.pop(blob_idx, None)
+            if not postings:
+                del self.postings[term]
+        self.lengths[blob_idx] = self.lengths.get(blob_idx, 0) + delta
+        self.total_length += delta
+
+    def remove(self, blob_idx):
+        if blob_idx not in self.docs:
+            return
+        for field in list(self.docs[blob_idx]["fields"]):
+            self.set_counts(blob_idx, field, {})
+        del self.docs[blob_idx]
+        self.lengths.pop(blob_idx, None)
+
+    # Returns [(blob_idx, where, score)] for the documents containing
+    # every term, best match first
+    def search(self, text, limit=None):
+        terms = set(tokenize(text))
+        if not terms:
+            return []
+        matches = [self.postings.get(term, {}) for term in terms]
+        matches.sort(key=len)
+        candidates = set(matches[0]).intersection(*matches[1:])
+
+        count = len(self.docs)
+        average = self.total_length / count if count else 0
+        results = []
+        for blob_idx in candidates:
+            score = 0
+            norm = K1 * (1 - B + B * self.lengths[blob_idx] / average)
+            for postings in matches:
+                df = len(postings)
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                tf = postings[blob_idx]
+                score += idf * tf * (K1 + 1) / (tf + norm)
+            results.append((blob_idx, self.docs[blob_idx]["where"], score))
+        results.sort(key=lambda result: result[2], reverse=True)
+        if limit is not None:
+            results = results[:limit]
+        return results
+
+    # Replaces the snapshot with the current state
+    def save(self):
+        snapshot = json.dumps({
+            "seq": self.seq,
+            "docs": self.docs,
+        })
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self.snapshot_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path())
+        fsync_dir(self.path)
+
+    def stats(self):
+        return {
+            "documents": len(self.docs),
+            "terms": len(self.postings),
+        }
@@ -0,0 +1,227 @@
+import contextlib, json, os, sqlite3, threading
+
+import tau_core.util
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    blob_idx TEXT PRIMARY KEY,
+    status TEXT,
+    project TEXT,
+    due INTEGER,
+    rank REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks(status);
+CREATE INDEX IF NOT EXISTS tasks_project ON tasks(project);
+CREATE INDEX IF NOT EXISTS tasks_due ON tasks(due);
+CREATE INDEX IF NOT EXISTS tasks_rank ON tasks(rank);
+
+CREATE TABLE IF NOT EXISTS history (
+    blob_idx TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    PRIMARY KEY (blob_idx, n)
+);
+
+CREATE TABLE IF NOT EXISTS active (
+    id INTEGER PRIMARY KEY,
+    blob_idx TEXT
+);
+CREATE INDEX IF NOT EXISTS active_free ON active(id) WHERE blob_idx IS NULL;
+
+CREATE TABLE IF NOT EXISTS archive (
+    month TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    blob_idx TEXT,
+    PRIMARY KEY (month, pos)
+);
+
+-- Single values stored as JSON, such as the change numbers
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Stores everything in a single sqlite database. Task attributes are kept
+# as JSON with the columns we filter and sort on pulled out and indexed.
+# Events live in the history table, and each task records how many of
+# them it reflects so later ones are replayed on load.
+class SqliteBackend:
+
+    def __init__(self, path, mode, checkpoint_interval):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.mode = mode
+        self.checkpoint_interval = checkpoint_interval
+        # Each storage thread gets its own connection
+        self.local = threading.local()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        if (db := getattr(self.local, "db", None)) is None:
+            db = self.local.db = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None)
+        return db
+
+    # Takes the write lock up front. A deferred transaction that reads
+    # first can't be upgraded once another thread committed meanwhile.
+    @contextlib.contextmanager
+    def transaction(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def history_length(self, blob_idx):
+        length, = self.db.execute(
+            "SELECT COALESCE(MAX(n) + 1, 0) FROM history WHERE blob_idx = ?",
+            (blob_idx,)).fetchone()
+        return length
+
+    def append_history(self, blob_idx, events):
+        first = self.history_length(blob_idx)
+        self.db.executemany(
+            "INSERT INTO history VALUES (?, ?, ?)",
+            [(blob_idx, first + i, json.dumps(event))
+             for i, event in enumerate(events)])
+
+    # Must be called inside a transaction
+    def write_task(self, task):
+        blob_idx = task["blob_idx"]
+        record = dict(task, history=self.history_length(blob_idx))
+        self.db.execute(
+            "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?)",
+            (blob_idx, task["status"], task["project"],
+             task["due"], task["rank"], json.dumps(record)))
+
+    def save_task(self, task):
+        with self.transaction():
+            self.write_task(task)
+
+    # Replaces any history already stored, so copying a task twice
+    # doesn't repeat its events
+    def add_task(self, task, events):
+        with self.transaction():
+            self.db.execute("DELETE FROM history WHERE blob_idx = ?",
+                            (task["blob_idx"],))
+            self.append_history(task["blob_idx"], events)
+            self.write_task(task)
+
+    def load_task(self, blob_idx):
+        row = self.db.execute(
+            "SELECT data FROM tasks WHERE blob_idx = ?", (blob_idx,)
+        ).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"no task {blob_idx}")
+        task = json.loads(row[0])
+
+        # Apply events appended since the last checkpoint
+        history = self.db.execute(
+            "SELECT event FROM history WHERE blob_idx = ? AND n >= ? "
+            "ORDER BY n", (blob_idx, task.pop("history")))
+        for (event,) in history:
+            tau_core.util.apply_event(task, json.loads(event))
+        return task
+
+    def load_events(self, blob_idx):
+        rows = self.db.execute(
+            "SELECT event FROM history WHERE blob_idx = ? ORDER BY n",
+            (blob_idx,))
+        return [json.loads(event) for (event,) in rows]
+
+    def commit_task(self, task, events):
+        blob_idx = task["blob_idx"]
+        with self.transaction():
+            self.append_history(blob_idx, events)
+            applied, = self.db.execute(
+                "SELECT json_extract(data, '$.history') FROM tasks "
+                "WHERE blob_idx = ?", (blob_idx,)).fetchone()
+            unapplied = self.history_length(blob_idx) - applied
+            if self.mode != "log" or unapplied >= self.checkpoint_interval:
+                self.write_task(task)
+                return
+            # Keep the indexed columns current between checkpoints
+            self.db.execute(
+                "UPDATE tasks SET status = ?, project = ?, due = ?, rank = ? "
+                "WHERE blob_idx = ?",
+                (task["status"], task["project"], task["due"], task["rank"],
+                 blob_idx))
+
+    def checkpoint(self, task):
+        self.save_task(task)
+
+    # Archived tasks already share the database file with everything else
+    def repack(self, month):
+        return 0
+
+    # Every change is already committed in its own transaction
+    def flush(self):
+        pass
+
+    def flushed(self):
+        return None
+
+    def save_active(self, active):
+        with self.transaction():
+            self.db.execute("DELETE FROM active")
+            self.db.executemany("INSERT INTO active VALUES (?, ?)",
+                                enumerate(active))
+
+    def load_active(self):
+        rows = self.db.execute("SELECT blob_idx FROM active ORDER BY id")
+        return [blob_idx for (blob_idx,) in rows]
+
+    def allocate_id(self, blob_idx):
+        with self.transaction():
+            id, = self.db.execute(
+                "SELECT MIN(id) FROM active WHERE blob_idx IS NULL"
+            ).fetchone()
+            if id is None:
+                id, = self.db.execute(
+                    "SELECT COUNT(*) FROM active").fetchone()
+            self.db.execute("INSERT OR REPLACE INTO active VALUES (?, ?)",
+                            (id, blob_idx))
+        return id
+
+    def release_id(self, id):
+        with self.transaction():
+            self.db.execute("UPDATE active SET blob_idx = NULL WHERE id = ?",
+                            (id,))
+
+    def save_changes(self, changes):
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                            ("changes", json.dumps(changes)))
+
+    def load_changes(self):
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = ?", ("changes",)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def save_archive(self, month, archive):
+        with self.transaction():
+            self.db.execute("DELETE FROM archive WHERE month = ?", (month,))
+            self.db.executemany(
+                "INSERT INTO archive VALUES (?, ?, ?)",
+                [(month, pos, blob_idx) for pos, blob_idx in enumerate(archive)])
+
+    def load_archive(self, month):
+        rows = self.db.execute(
+            "SELECT blob_idx FROM archive WHERE month = ? ORDER BY pos",
+            (month,))
+        return [blob_idx for (blob_idx,) in rows]
+
+    def archive_months(self):
+        rows = self.db.execute(
+            "SELECT DISTINCT month FROM archive ORDER BY month")
+        return [month for (month,) in rows]
+
+    def all_blob_idxs(self):
+        rows = self.db.execute("SELECT blob_idx FROM tasks ORDER BY blob_idx")
+        return [blob_idx for (blob_idx,) in rows]
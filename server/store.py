@@ -0,0 +1,273 @@
+import asyncio, collections, os
+
+import tau_core.config
+import io_pool, locks, plumbing, query, search, task_index, util
+
+# Number of threads running blocking storage calls
+IO_THREADS = tau_core.config.get_int("io_threads", 4)
+
+# Resident copy of the active index and the active tasks' attributes.
+# Everything is loaded once at startup, reads are served from memory
+# and mutations are written through to disk by plumbing on the I/O pool.
+# Event history is not kept in memory and is only loaded on request.
+class TaskStore:
+
+    def __init__(self):
+        self.active = []
+        self.tasks = {}
+        # blob_idx -> active ID
+        self.ids = {}
+        self.index = task_index.TaskIndex()
+        # Every change to the active list gets the next sequence number,
+        # and stamps holds the latest one for each ID, most recent last.
+        # They are saved when the server stops. After a crash they are
+        # lost, so a new epoch tells clients to fetch everything again.
+        self.epoch = None
+        self.seq = 0
+        self.stamps = collections.OrderedDict()
+        # Full-text index of active and archived tasks
+        self.fulltext = search.SearchIndex(f"{util.config_path()}/data/search")
+        self.io = io_pool.IOPool(IO_THREADS)
+        # Writes to the same task or index are applied in order
+        self.locks = locks.LockManager()
+
+    def load(self):
+        saved = self.load_changes()
+        self.active = plumbing.load_active()
+        self.tasks = {}
+        self.ids = {}
+        self.index = task_index.TaskIndex()
+        for id, blob_idx in enumerate(self.active):
+            if blob_idx is None:
+                continue
+            try:
+                self.tasks[blob_idx] = plumbing.load_task(blob_idx)
+            except FileNotFoundError:
+                # Lost with the writes of a crash before they were flushed
+                print(f"Task {blob_idx} with ID {id} is missing, freeing its ID")
+                self.active[id] = None
+                plumbing.release_id(id)
+                continue
+            self.ids[blob_idx] = id
+            self.index.add(id, self.tasks[blob_idx])
+        print(f"Loaded {len(self.tasks)} active tasks")
+        # The index is only saved by a clean stop, which records where
+        # it was, so after a crash it is behind the tasks
+        if not (saved is not None and self.fulltext.load()
+                and self.fulltext_current(saved.get("search_seq"))):
+            self.build_fulltext()
+
+    # Whether the index loaded from disk is the one saved by the last
+    # clean stop and agrees with the store on which tasks are active
+    def fulltext_current(self, search_seq):
+        if self.fulltext.seq != search_seq:
+            return False
+        active = {blob_idx for blob_idx, doc in self.fulltext.docs.items()
+                  if doc["where"] is None}
+        return active == set(self.tasks)
+
+    # Returns the changes saved by the last clean stop, or None
+    def load_changes(self):
+        changes = plumbing.load_changes()
+        if changes is None or not changes["clean"]:
+            changes = None
+            print("Changes since the last start are unknown, "
+                  "clients will fetch every task")
+            self.epoch = os.urandom(8).hex()
+            self.seq = 0
+            self.stamps = collections.OrderedDict()
+        else:
+            self.epoch = changes["epoch"]
+            self.seq = changes["seq"]
+            self.stamps = collections.OrderedDict(changes["stamps"])
+        # Stays marked unclean until close(), in case the server crashes
+        plumbing.save_changes(self.changes(False))
+        plumbing.flush()
+        return changes
+
+    def changes(self, clean):
+        return {
+            "epoch": self.epoch,
+            "seq": self.seq,
+            "stamps": list(self.stamps.items()),
+            "search_seq": self.fulltext.seq,
+            "clean": clean,
+        }
+
+    # Saves what is only kept in memory, once the server stopped serving
+    def close(self):
+        self.io.executor.shutdown()
+        self.fulltext.save()
+        plumbing.save_changes(self.changes(True))
+        plumbing.flush()
+
+    # Indexes every task for search, replacing any index on disk
+    def build_fulltext(self):
+        print("Building search index")
+        self.fulltext = search.SearchIndex(self.fulltext.path)
+        for blob_idx, task in self.tasks.items():
+            self.fulltext.add(task, plumbing.load_events(blob_idx))
+        for month in plumbing.archive_months():
+            for pos, blob_idx in enumerate(plumbing.load_archive(month)):
+                if blob_idx is None:
+                    continue
+                self.fulltext.add(plumbing.load_task(blob_idx),
+                                  plumbing.load_events(blob_idx),
+                                  [month, pos])
+        self.fulltext.save()
+        print(f"Indexed {len(self.fulltext.docs)} tasks for search")
+
+    # Finds the blob's index from its active ID
+    def blob_idx_from_id(self, id):
+        try:
+            return self.active[id]
+        except IndexError:
+            return None
+
+    # Returns the resident task object. Callers must not modify it,
+    # instead make a copy and pass it to update().
+    def get(self, id):
+        if (blob_idx := self.blob_idx_from_id(id)) is None:
+            return None
+        return self.tasks[blob_idx]
+
+    def active_tasks(self):
+        tasks = []
+        for blob_idx in self.active:
+            if blob_idx is None:
+                tasks.append(None)
+                continue
+            tasks.append(self.tasks[blob_idx])
+        return tasks
+
+    async def add(self, task, events):
+        blob_idx = task["blob_idx"]
+        async with self.locks.hold(("task", blob_idx)):
+            await self.io.run(plumbing.add_task, task, events)
+        async with self.locks.hold(("active",)):
+            id = await self.io.run(plumbing.allocate_id, blob_idx)
+        while len(self.active) <= id:
+            self.active.append(None)
+        self.active[id] = blob_idx
+        self.tasks[blob_idx] = task
+        self.ids[blob_idx] = id
+        self.index.add(id, task)
+        self.stamp(id)
+        self.fulltext.add(task, events)
+        await self.durable()
+        return id
+
+    # Loading updates the backend's record of the task's history, so it
+    # must not overlap a commit to the same task
+    async def events(self, blob_idx):
+        async with self.locks.hold(("task", blob_idx)):
+            return await self.io.run(plumbing.load_events, blob_idx)
+
+    # Persists the task along with the events that changed it.
+    # The resident copy is replaced before anything is awaited so
+    # requests arriving meanwhile already see the change.
+    async def update(self, task, events):
+        blob_idx = task["blob_idx"]
+        id = self.ids[blob_idx]
+        # Comments pass the resident task since its attributes stay the same
+        if self.tasks[blob_idx] is not task:
+            self.index.update(id, self.tasks[blob_idx], task)
+            self.stamp(id)
+        self.tasks[blob_idx] = task
+        self.fulltext.update(blob_idx, events)
+        async with self.locks.hold(("task", task["blob_idx"])):
+            await self.io.run(plumbing.commit_task, task, events)
+        await self.durable()
+
+    # Like update() but also moves the task from the active list
+    # to the archive for the given month.
+    async def archive(self, id, task, events, month):
+        self.active[id] = None
+        self.index.remove(id, self.tasks.pop(task["blob_idx"]))
+        del self.ids[task["blob_idx"]]
+        self.stamp(id)
+        self.fulltext.update(task["blob_idx"], events)
+        async with self.locks.hold(("task", task["blob_idx"]), ("active",),
+                                   ("archive", month)):
+            await self.io.run(plumbing.commit_task, task, events)
+            pos = await self.io.run(plumbing.archive_task, id, task, month)
+        self.fulltext.move(task["blob_idx"], [month, pos])
+        await self.durable()
+
+    # Waits until the changes written so far are on disk, so they are
+    # only acknowledged once a crash can't lose them. Within the commit
+    # window this waits for the flush shared with other changes.
+    async def durable(self):
+        if (flushed := await self.io.run(plumbing.flushed)) is not None:
+            await asyncio.wrap_future(flushed)
+
+    def stamp(self, id):
+        self.seq += 1
+        self.stamps[id] = self.seq
+        self.stamps.move_to_end(id)
+
+    # Returns the IDs changed after seq, in the order of their last change
+    def changed_since(self, seq):
+        ids = []
+        for id, stamp in reversed(self.stamps.items()):
+            if stamp <= seq:
+                break
+            ids.append(id)
+        ids.reverse()
+        return ids
+
+    # Returns (id, task) pairs of the active tasks matching a query
+    # from query.compile_filter(), answered from the indexes
+    def select(self, fltr, sort=None, limit=None, after=None):
+        return query.select(fltr, self.index, self.get, sort, limit, after)
+
+    # Returns [(id, month, score, task)] for the tasks best matching the
+    # text, where month is None for active tasks
+    async def search(self, text, limit=None):
+        results = []
+        for blob_idx, where, score in self.fulltext.search(text, limit):
+            if where is None:
+                if (id := self.ids.get(blob_idx)) is None:
+                    # Still being archived
+                    continue
+                results.append((id, None, score, self.tasks[blob_idx]))
+                continue
+            month, id = where
+            # Repacking the month replaces its pack under the month lock
+            async with self.locks.hold(("task", blob_idx), ("archive", month)):
+                task = await self.io.run(plumbing.load_task, blob_idx)
+            results.append((id, month, score, task))
+        return results
+
+    # Returns up to count (id, task) pairs with IDs following after
+    def active_page(self, after, count):
+        rows = []
+        for id in range(max(after + 1, 0), len(self.active)):
+            if len(rows) == count:
+                break
+            if (blob_idx := self.active[id]) is not None:
+                rows.append((id, self.tasks[blob_idx]))
+        return rows
+
+    # Holding the month keeps these from loading a task while archive()
+    # is still committing it
+    async def archive_tasks(self, month):
+        async with self.locks.hold(("archive", month)):
+            return await self.io.run(plumbing.load_archive_tasks, month)
+
+    async def archive_page(self, month, after, count):
+        async with self.locks.hold(("archive", month)):
+            return await self.io.run(plumbing.load_archive_page,
+                                     month, after, count)
+
+    async def archive_task(self, id, month):
+        async with self.locks.hold(("archive", month)):
+            return await self.io.run(plumbing.load_archive_task, id, month)
+
+    # Packs every archive month that is no longer being appended to
+    async def repack_cold_archives(self):
+        for month in await self.io.run(plumbing.archive_months):
+            if month == util.current_month():
+                continue
+            async with self.locks.hold(("archive", month)):
+                await self.io.run(plumbing.repack, month)
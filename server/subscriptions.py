@@ -0,0 +1,65 @@
+import asyncio
+
+# Events held for a subscriber that hasn't taken them yet. Past this it
+# is too slow to keep up and gets an overflow event instead.
+QUEUE_SIZE = 256
+
+# Pushed in place of the events a slow subscriber missed, telling it to
+# refetch what it is showing, for example with fetch_changes_since
+OVERFLOW = {"update": "overflow", "params": []}
+
+class Subscription:
+
+    def __init__(self, hub, query):
+        self.hub = hub
+        self.query = query
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        self.overflows = 0
+
+    def push(self, event):
+        if self.queue.full():
+            # Nothing queued is worth sending once events were lost,
+            # so make room for the overflow and what follows it
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(OVERFLOW)
+            self.overflows += 1
+            self.hub.overflows += 1
+        self.queue.put_nowait(event)
+
+    async def events(self):
+        while True:
+            yield await self.queue.get()
+
+    def close(self):
+        self.hub.subscriptions.discard(self)
+
+# Fans task changes out to the connections which subscribed to them.
+# Publishing never waits on a subscriber, each has its own bounded queue
+# drained by its connection as fast as the client reads.
+class SubscriptionHub:
+
+    def __init__(self):
+        self.subscriptions = set()
+        self.overflows = 0
+
+    def subscribe(self, query):
+        subscription = Subscription(self, query)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    # tasks are the task before and after the change. Subscribers get
+    # the event when either matches, so they also see tasks leave.
+    def publish(self, event, tasks):
+        for subscription in list(self.subscriptions):
+            if any(task is not None and subscription.query.match(task)
+                   for task in tasks):
+                subscription.push(event)
+
+    def stats(self):
+        return {
+            "subscribers": len(self.subscriptions),
+            "queued": sum(subscription.queue.qsize()
+                          for subscription in self.subscriptions),
+            "overflows": self.overflows,
+        }
@@ -0,0 +1,134 @@
+import bisect
+
+# Attributes kept in sorted order, for ranges and sorting
+ORDERED = ["due", "rank"]
+
+# Secondary indexes over the active tasks, keyed by active ID. Tags,
+# assignees, status and project map to the set of tasks having them,
+# while due and rank are kept sorted. TaskStore updates them with every
+# change to a resident task so queries only visit the tasks they need.
+# The returned sets belong to the index and must not be modified.
+class TaskIndex:
+
+    def __init__(self):
+        self.ids = set()
+        self.tags = {}
+        self.assigned = {}
+        self.status = {}
+        self.project = {}
+        # Sorted project names for prefix lookups
+        self.projects = []
+        # attr -> sorted [(value, id)]
+        self.ordered = {attr: [] for attr in ORDERED}
+        # attr -> ids of the tasks where it's None
+        self.unset = {attr: set() for attr in ORDERED + ["project"]}
+
+    def add(self, id, task):
+        self.ids.add(id)
+        for tag in task["tags"]:
+            self.tags.setdefault(tag, set()).add(id)
+        for assign in task["assigned"]:
+            self.assigned.setdefault(assign, set()).add(id)
+        self.status.setdefault(task["status"], set()).add(id)
+
+        if (project := task["project"]) is None:
+            self.unset["project"].add(id)
+        else:
+            if project not in self.project:
+                bisect.insort(self.projects, project)
+            self.project.setdefault(project, set()).add(id)
+
+        for attr in ORDERED:
+            if task[attr] is None:
+                self.unset[attr].add(id)
+            else:
+                bisect.insort(self.ordered[attr], (task[attr], id))
+
+    def remove(self, id, task):
+        self.ids.discard(id)
+        for tag in task["tags"]:
+            discard(self.tags, tag, id)
+        for assign in task["assigned"]:
+            discard(self.assigned, assign, id)
+        discard(self.status, task["status"], id)
+
+        if (project := task["project"]) is None:
+            self.unset["project"].discard(id)
+        elif discard(self.project, project, id):
+            del self.projects[bisect.bisect_left(self.projects, project)]
+
+        for attr in ORDERED:
+            if task[attr] is None:
+                self.unset[attr].discard(id)
+                continue
+            entries = self.ordered[attr]
+            i = bisect.bisect_left(entries, (task[attr], id))
+            if i < len(entries) and entries[i] == (task[attr], id):
+                del entries[i]
+
+    def update(self, id, old, new):
+        self.remove(id, old)
+        self.add(id, new)
+
+    def with_tag(self, tag):
+        return self.tags.get(tag, set())
+
+    def with_assigned(self, assign):
+        return self.assigned.get(assign, set())
+
+    def with_status(self, status):
+        return self.status.get(status, set())
+
+    def with_project_prefix(self, prefix):
+        ids = set()
+        i = bisect.bisect_left(self.projects, prefix)
+        while i < len(self.projects) and self.projects[i].startswith(prefix):
+            ids |= self.project[self.projects[i]]
+            i += 1
+        return ids
+
+    def with_unset(self, attr):
+        return self.unset[attr]
+
+    # Tasks whose attribute lies between low and high inclusive,
+    # either of which can be None to leave that end open
+    def with_range(self, attr, low, high):
+        entries = self.ordered[attr]
+        start = 0 if low is None else bisect.bisect_left(entries, (low,))
+        end = (len(entries) if high is None
+               else bisect.bisect_right(entries, (high, float("inf"))))
+        return {id for _, id in entries[start:end]}
+
+    # IDs of the tasks that have the attribute set, sorted on it.
+    # Starts after the (value, id) entry start if given.
+    def walk(self, attr, reverse=False, start=None):
+        entries = self.ordered[attr]
+        if reverse:
+            end = (len(entries) if start is None
+                   else bisect.bisect_left(entries, start))
+            for i in range(end - 1, -1, -1):
+                yield entries[i][1]
+        else:
+            begin = 0 if start is None else bisect.bisect_right(entries, start)
+            for i in range(begin, len(entries)):
+                yield entries[i][1]
+
+    def stats(self):
+        return {
+            "tasks": len(self.ids),
+            "tags": len(self.tags),
+            "assigned": len(self.assigned),
+            "projects": len(self.projects),
+        }
+
+# Removes the id from the set under key, dropping the set once empty.
+# Returns whether it was dropped.
+def discard(sets, key, id):
+    ids = sets.get(key)
+    if ids is None:
+        return False
+    ids.discard(id)
+    if ids:
+        return False
+    del sets[key]
+    return True
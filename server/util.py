@@ -1,4 +1,4 @@
-import os, random, time
+import os, random, string, time
 from datetime import date, datetime
 
 def config_path():
@@ -10,8 +10,20 @@ def safe_open(filename, perm):
     os.makedirs(os.path.dirname(filename), exist_ok=True)
     return open(filename, perm)
 
+# Makes renames and removals inside a directory durable
+def fsync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 # returns MMYY format
 def current_month():
     today = date.today()
     return today.strftime("%m%y")
 
+# Blob indexes are used in file paths and stored in 32 byte index records
+def is_valid_blob_idx(blob_idx):
+    return (isinstance(blob_idx, str) and 0 < len(blob_idx) <= 32
+            and all(c in string.hexdigits for c in blob_idx))
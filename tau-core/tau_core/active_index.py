@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""Fixed-width record file for the tau2 active task index"""
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = b"TAUA"
+VERSION = 1
+# magic, version, number of slots, head of the free slot list
+HEADER = struct.Struct("<4sIqq")
+# in use flag, blob_idx length, blob_idx, next free slot
+RECORD = struct.Struct("<BB32sq")
+NO_SLOT = -1
+INITIAL_CAPACITY = 64
+
+
+def read_active_index(path):
+    """Read an active index file into a list of blob indexes"""
+    with open(path, "rb") as f:
+        data = f.read()
+    _, _, length, _ = HEADER.unpack_from(data, 0)
+    return [_decode_record(data, slot)[0] for slot in range(length)]
+
+
+def _record_offset(slot):
+    return HEADER.size + slot * RECORD.size
+
+
+def _decode_record(buf, slot):
+    used, size, blob_idx, next_free = RECORD.unpack_from(
+        buf, _record_offset(slot))
+    if not used:
+        return None, next_free
+    return blob_idx[:size].decode(), next_free
+
+
+class ActiveIndex:
+    """
+    Active task slots stored as fixed-width records in a memory-mapped file
+
+    Free slots form a linked list threaded through their records, with the
+    head kept in the file header. Allocating or releasing a slot rewrites
+    one record and the header in place, independent of the number of slots.
+
+    Changes are kept in memory until sync() writes them to the file, so
+    the caller decides when they may reach the disk. Pages of a mapping
+    can be written back at any time, so they are only touched by sync().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        # slot -> (blob_idx, next free slot) not written to the file yet
+        self.pending = {}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < _record_offset(INITIAL_CAPACITY):
+            os.ftruncate(self.fd, _record_offset(INITIAL_CAPACITY))
+        self.map()
+
+        magic, version, self.length, self.free_head = \
+            HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            # Fresh file, or one whose creation was interrupted
+            self.length, self.free_head = 0, NO_SLOT
+            self.sync()
+        elif version != VERSION:
+            raise ValueError(f"unsupported active index version {version}")
+        elif not self.free_list_valid():
+            self.rebuild_free_list()
+            self.sync()
+
+    def map(self):
+        self.capacity = (os.fstat(self.fd).st_size - HEADER.size) // RECORD.size
+        self.mm = mmap.mmap(self.fd, _record_offset(self.capacity))
+
+    def grow(self):
+        self.mm.close()
+        os.ftruncate(self.fd, _record_offset(self.capacity * 2))
+        self.map()
+
+    def write_header(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION,
+                         self.length, self.free_head)
+
+    def write_record(self, slot, blob_idx, next_free=NO_SLOT):
+        if blob_idx is not None and len(blob_idx.encode()) > 32:
+            raise ValueError(f"blob_idx too long: {blob_idx}")
+        self.pending[slot] = (blob_idx, next_free)
+
+    def read_record(self, slot):
+        if (record := self.pending.get(slot)) is not None:
+            return record
+        return _decode_record(self.mm, slot)
+
+    def __len__(self):
+        return self.length
+
+    def get(self, slot):
+        """Return the blob index in a slot or None if it is free"""
+        with self.lock:
+            return self.read_record(slot)[0]
+
+    def to_list(self):
+        """Return all slots as a list with None for free slots"""
+        with self.lock:
+            return [self.get(slot) for slot in range(self.length)]
+
+    def allocate(self, blob_idx):
+        """Store blob_idx in a free slot, or a new one at the end"""
+        with self.lock:
+            if self.free_head != NO_SLOT:
+                slot = self.free_head
+                self.free_head = self.read_record(slot)[1]
+            else:
+                slot = self.length
+                self.length += 1
+            self.write_record(slot, blob_idx)
+            return slot
+
+    def release(self, slot):
+        """Mark a slot as free so it can be reused"""
+        with self.lock:
+            self.write_record(slot, None, self.free_head)
+            self.free_head = slot
+
+    def reset(self, active):
+        """Replace the whole index with a list of blob indexes"""
+        with self.lock:
+            self.length = len(active)
+            self.free_head = NO_SLOT
+            # Link free slots in ascending order so low IDs get reused first
+            for slot in reversed(range(self.length)):
+                if active[slot] is None:
+                    self.write_record(slot, None, self.free_head)
+                    self.free_head = slot
+                else:
+                    self.write_record(slot, active[slot])
+
+    def free_list_valid(self):
+        seen = set()
+        slot = self.free_head
+        while slot != NO_SLOT:
+            if slot in seen or not 0 <= slot < self.length:
+                return False
+            blob_idx, next_free = self.read_record(slot)
+            if blob_idx is not None:
+                return False
+            seen.add(slot)
+            slot = next_free
+        free_count = sum(1 for slot in range(self.length)
+                         if self.get(slot) is None)
+        return len(seen) == free_count
+
+    def rebuild_free_list(self):
+        self.reset(self.to_list())
+
+    def sync(self):
+        """Write the changes made so far to the file and flush them to disk"""
+        with self.lock:
+            while self.capacity < self.length:
+                self.grow()
+            for slot, (blob_idx, next_free) in self.pending.items():
+                if blob_idx is None:
+                    RECORD.pack_into(self.mm, _record_offset(slot),
+                                     0, 0, b"", next_free)
+                    continue
+                data = blob_idx.encode()
+                RECORD.pack_into(self.mm, _record_offset(slot),
+                                 1, len(data), data, NO_SLOT)
+            self.write_header()
+            self.pending.clear()
+            self.mm.flush()
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
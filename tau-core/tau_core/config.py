@@ -1,21 +1,30 @@
 #!/usr/bin/env python3
 """Configuration loading for tau tools"""
 import os
+import signal
 import sys
+import threading
+import time
 import toml
 
+# Seconds between checks whether the file changed. Servers also reload
+# it straight away on SIGHUP.
+CHECK_INTERVAL = 1.0
 
-def load_config():
-    """Load tau configuration from TOML file"""
+
+def config_filename():
+    """Path of the TOML file, from TAU_CONFIG or the default"""
     try:
         cfg_filename = os.environ["TAU_CONFIG"]
     except KeyError:
         cfg_filename = "~/.config/tau/tau.toml"
+    return os.path.expanduser(cfg_filename)
 
-    cfg_filename = os.path.expanduser(cfg_filename)
 
+def load_config():
+    """Load tau configuration from TOML file"""
     try:
-        with open(cfg_filename) as f:
+        with open(config_filename()) as f:
             cfg = toml.load(f)
     except toml.TomlDecodeError:
         print("error: decoding toml failed", file=sys.stderr)
@@ -26,11 +35,151 @@ def load_config():
     return cfg
 
 
+class Config:
+    """
+    The parsed configuration file, shared by the whole process
+
+    The file is parsed once and only parsed again when its modification
+    time or size changed, which is looked at no more than once every
+    CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cfg = None
+        self.stamp = None
+        self.checked = None
+        # Values computed from the config, dropped when it changes
+        self.derived = {}
+
+    def file_stamp(self):
+        try:
+            st = os.stat(config_filename())
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def current(self):
+        """The parsed config, or None when there is no usable file"""
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < CHECK_INTERVAL:
+            return self.cfg
+        with self.lock:
+            self.checked = now
+            if (stamp := self.file_stamp()) != self.stamp:
+                self.load(stamp)
+            return self.cfg
+
+    def load(self, stamp):
+        if stamp is None:
+            cfg = None
+        elif (cfg := load_config()) is None and self.cfg is not None:
+            # Keep running on the last good config rather than defaults
+            print("warning: keeping the previous configuration",
+                  file=sys.stderr)
+            cfg = self.cfg
+        self.cfg = cfg
+        self.stamp = stamp
+        self.derived = {}
+
+    def reload(self):
+        """Parse the file again on the next access"""
+        with self.lock:
+            self.checked = None
+            self.stamp = ()
+
+    def get(self, attr, default_value):
+        """Get configuration attribute with default value"""
+        if (cfg := self.current()) is None:
+            return default_value
+        return cfg.get(attr, default_value)
+
+    def get_typed(self, attr, default_value, types):
+        cfg = self.current()
+        if cfg is None or attr not in cfg:
+            return default_value
+        value = cfg[attr]
+        # bool is an int but true isn't a sensible number of threads
+        if not isinstance(value, types) or (
+                isinstance(value, bool) and bool not in types):
+            print(f"warning: config {attr} should be {types[0].__name__}, "
+                  f"using {default_value!r}", file=sys.stderr)
+            return default_value
+        return value
+
+    def get_str(self, attr, default_value):
+        """Get a string attribute, or the default if it's another type"""
+        return self.get_typed(attr, default_value, (str,))
+
+    def get_int(self, attr, default_value):
+        """Get an integer attribute, or the default if it's another type"""
+        return self.get_typed(attr, default_value, (int,))
+
+    def get_float(self, attr, default_value):
+        """Get a number attribute as float, or the default if not a number"""
+        value = self.get_typed(attr, default_value, (float, int))
+        return value if value is None else float(value)
+
+    def get_bool(self, attr, default_value):
+        """Get a boolean attribute, or the default if it's another type"""
+        return self.get_typed(attr, default_value, (bool,))
+
+    def derive(self, name, func):
+        """
+        Compute a value from the config once and reuse it
+
+        Args:
+            name: Key the value is kept under
+            func: Called with this Config to compute the value again
+                after the config changed
+        """
+        cfg = self.current()
+        try:
+            return self.derived[name]
+        except KeyError:
+            value = func(self)
+            # Don't keep a value computed from a config replaced meanwhile
+            if cfg is self.cfg:
+                self.derived[name] = value
+            return value
+
+
+# The configuration of this process
+settings = Config()
+
+
 def get(attr, default_value):
     """Get configuration attribute with default value"""
-    if (cfg := load_config()) is None:
-        return default_value
-    try:
-        return cfg[attr]
-    except KeyError:
-        return default_value
+    return settings.get(attr, default_value)
+
+
+def get_str(attr, default_value):
+    """Get a string attribute with default value"""
+    return settings.get_str(attr, default_value)
+
+
+def get_int(attr, default_value):
+    """Get an integer attribute with default value"""
+    return settings.get_int(attr, default_value)
+
+
+def get_float(attr, default_value):
+    """Get a number attribute as float with default value"""
+    return settings.get_float(attr, default_value)
+
+
+def get_bool(attr, default_value):
+    """Get a boolean attribute with default value"""
+    return settings.get_bool(attr, default_value)
+
+
+def derive(name, func):
+    """Compute a value from the config once, see Config.derive"""
+    return settings.derive(name, func)
+
+
+def reload_on_sighup(loop):
+    """Reload the config when the process receives SIGHUP"""
+    # Not available on Windows
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, settings.reload)
@@ -1,12 +1,34 @@
 #!/usr/bin/env python3
 """Data access layer for tau2 tasks"""
 import json
+import sqlite3
 from pathlib import Path
+from . import config
+from .active_index import read_active_index
 from .storage import TAU_DATA_DIR
+from .util import apply_event
+
+
+def open_tau_db():
+    """Open tau2's database if the server uses the sqlite backend"""
+    if config.get_str("storage_backend", "files") != "sqlite":
+        return None
+    db_file = TAU_DATA_DIR / "tau.db"
+    if not db_file.exists():
+        return None
+    return sqlite3.connect(db_file)
 
 
 def load_active():
     """Load active tasks index from tau2"""
+    if (db := open_tau_db()) is not None:
+        with db:
+            rows = db.execute("SELECT blob_idx FROM active ORDER BY id")
+            return [blob_idx for (blob_idx,) in rows]
+    index_file = TAU_DATA_DIR / "active.idx"
+    if index_file.exists():
+        return read_active_index(index_file)
+    # Written by older tau2 servers
     active_file = TAU_DATA_DIR / "active"
     if not active_file.exists():
         return []
@@ -18,12 +40,46 @@ def load_task_blob(blob_idx):
     """Load a task blob from tau2"""
     if not blob_idx:
         return None
+    if (db := open_tau_db()) is not None:
+        return load_task_row(db, blob_idx)
     blob_prefix = blob_idx[:2]
     blob_file = TAU_DATA_DIR / "blob" / blob_prefix / blob_idx
     if not blob_file.exists():
         return None
     with open(blob_file) as f:
-        return json.load(f)
+        task = json.load(f)
+    # Written by older tau2 servers, with the events inside
+    if "events" in task:
+        return task
+
+    # Apply events appended to the history since the blob was written
+    history_file = TAU_DATA_DIR / "history" / blob_prefix / blob_idx
+    offset = task.pop("history")
+    if history_file.exists():
+        with open(history_file) as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    apply_event(task, json.loads(line))
+                except ValueError:
+                    continue
+    return task
+
+
+def load_task_row(db, blob_idx):
+    """Load a task from tau2's database"""
+    with db:
+        row = db.execute("SELECT data FROM tasks WHERE blob_idx = ?",
+                         (blob_idx,)).fetchone()
+        if row is None:
+            return None
+        task = json.loads(row[0])
+        events = db.execute(
+            "SELECT event FROM history WHERE blob_idx = ? AND n >= ? "
+            "ORDER BY n", (blob_idx, task.pop("history")))
+        for (event,) in events:
+            apply_event(task, json.loads(event))
+    return task
 
 
 def get_task_by_id(task_id):
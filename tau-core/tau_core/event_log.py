@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Durable event log shared between the tau server and its consumers"""
+import json
+import os
+import sys
+
+# Bytes written to a segment before starting the next one
+SEGMENT_SIZE = 1 << 20
+# Segments kept even when a consumer hasn't read them yet, so one that
+# went away for good can't fill the disk
+MAX_SEGMENTS = 64
+
+
+def default_path():
+    """Where the tau server writes its events"""
+    return os.path.expanduser("~/.config/tau/data/events")
+
+
+def segment_path(path, start):
+    """Path of the segment whose first byte is at the given offset"""
+    return f"{path}/{start:020d}.log"
+
+
+def list_segments(path):
+    """Sorted start offsets of the segments in the log"""
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[:-4]) for name in names
+                  if name.endswith(".log") and name[:-4].isdigit())
+
+
+def load_cursors(path):
+    """Offsets each consumer will read from next, by consumer name"""
+    cursors = {}
+    try:
+        names = os.listdir(f"{path}/consumers")
+    except FileNotFoundError:
+        return cursors
+    for name in names:
+        if name.endswith(".tmp"):
+            continue
+        try:
+            with open(f"{path}/consumers/{name}") as f:
+                cursors[name] = int(f.read())
+        except (FileNotFoundError, ValueError):
+            pass
+    return cursors
+
+
+class EventLog:
+    """
+    Appends events to a log directory of segment files
+
+    Events are written one JSON document per line. A segment is named
+    after the offset of its first byte in the whole log, so an offset
+    locates an event without any index. Writing never waits for the
+    consumers, which each read at their own pace from their own cursor.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE,
+                 max_segments=MAX_SEGMENTS):
+        """
+        Args:
+            path: Directory holding the segments
+            segment_size: Bytes written to a segment before rolling over
+            max_segments: Segments kept for consumers which fell behind
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.file = None
+        self.start = 0
+        self.size = 0
+
+    def open(self):
+        """Open the newest segment for appending"""
+        os.makedirs(f"{self.path}/consumers", exist_ok=True)
+        segments = list_segments(self.path)
+        self.start = segments[-1] if segments else 0
+        filename = segment_path(self.path, self.start)
+        # A crash can leave half an event at the end, which would
+        # otherwise be glued to the next one
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        self.size = data.rfind(b"\n") + 1
+        self.file = open(filename, "ab")
+        if self.size < len(data):
+            self.file.truncate(self.size)
+
+    def append(self, event):
+        """Append an event, returning the offset just after it"""
+        if self.file is None:
+            self.open()
+        data = (json.dumps(event) + "\n").encode()
+        if self.size and self.size + len(data) > self.segment_size:
+            self.roll()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        return self.start + self.size
+
+    def end(self):
+        """Offset the next event will be written at"""
+        if self.file is None:
+            self.open()
+        return self.start + self.size
+
+    def roll(self):
+        """Close the current segment and start the next one"""
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.start += self.size
+        self.size = 0
+        self.file = open(segment_path(self.path, self.start), "ab")
+        self.prune()
+
+    def prune(self):
+        """Remove the segments every consumer has read past"""
+        segments = list_segments(self.path)
+        cursors = load_cursors(self.path).values()
+        oldest = min(cursors, default=0)
+        excess = len(segments) - self.max_segments
+        # A segment ends where the next one starts
+        for i, (start, end) in enumerate(zip(segments, segments[1:])):
+            if end > oldest and i >= excess:
+                break
+            os.remove(segment_path(self.path, start))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return {
+            "segments": len(list_segments(self.path)),
+            "end": self.end(),
+            "consumers": load_cursors(self.path),
+        }
+
+
+class Consumer:
+    """
+    Reads an EventLog from a cursor saved under a name
+
+    Several consumers can read the same log, each resuming after a
+    restart from the last position it committed. Events are delivered
+    at least once: those read but not yet committed come again.
+    """
+
+    def __init__(self, path, name, from_start=False):
+        """
+        Args:
+            path: Directory holding the segments
+            name: Name the cursor is saved under
+            from_start: Where a consumer without a saved cursor begins,
+                at the oldest event kept or only with new ones
+        """
+        self.path = path
+        self.cursor_path = f"{path}/consumers/{name}"
+        os.makedirs(f"{path}/consumers", exist_ok=True)
+        try:
+            with open(self.cursor_path) as f:
+                self.position = int(f.read())
+        except (FileNotFoundError, ValueError):
+            segments = list_segments(path)
+            if from_start or not segments:
+                self.position = segments[0] if segments else 0
+            else:
+                self.position = segments[-1] + os.path.getsize(
+                    segment_path(path, segments[-1]))
+            self.commit()
+
+    def read(self, max_events=100):
+        """Return up to max_events events after the position, if any"""
+        return [event for event, _ in self.read_positions(max_events)]
+
+    def read_positions(self, max_events=100):
+        """
+        Like read(), returning (event, position) pairs
+
+        The position is just after the event, for committing only part
+        of the events read.
+        """
+        events = []
+        while len(events) < max_events:
+            segments = list_segments(self.path)
+            if not segments:
+                break
+            if self.position < segments[0]:
+                print(f"warning: events before {segments[0]} were dropped "
+                      "from the log before being read", file=sys.stderr)
+                self.position = segments[0]
+            start = max(s for s in segments if s <= self.position)
+            try:
+                f = open(segment_path(self.path, start), "rb")
+            except FileNotFoundError:
+                # Pruned meanwhile, look again
+                continue
+            with f:
+                f.seek(self.position - start)
+                for line in f:
+                    # Left for later until it's written completely
+                    if not line.endswith(b"\n"):
+                        break
+                    self.position += len(line)
+                    events.append((json.loads(line), self.position))
+                    if len(events) == max_events:
+                        break
+                done = self.position - start == os.fstat(f.fileno()).st_size
+            # Carry on in the next segment once this one is read
+            if not done or start == segments[-1]:
+                break
+        return events
+
+    def commit(self, position=None):
+        """
+        Save the position, so the events read are not read again
+
+        Args:
+            position: Where to resume after a restart, if not after
+                every event read
+        """
+        if position is None:
+            position = self.position
+        tmp_path = f"{self.cursor_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(position))
+        os.replace(tmp_path, self.cursor_path)
@@ -1,37 +1,225 @@
 #!/usr/bin/env python3
 """Encrypted network communication channel for tau RPC"""
+import asyncio
 import json
+import lzma
+import struct
 import sys
+import zlib
 from Crypto.Cipher import AES
 
 from . import config
 
+# Binary frames start with their type, which can't begin the hex lines
+# of the original format, so each message says which format it is in.
+# The type also says how the plaintext was compressed.
+FRAME_PLAIN = 0x01
+FRAME_ZLIB = 0x02
+FRAME_LZMA = 0x03
+# Compression codecs by the frame type they are sent as
+CODECS = {"zlib": FRAME_ZLIB, "lzma": FRAME_LZMA}
+# Frame type, ciphertext length, nonce and tag, followed by the
+# ciphertext itself
+FRAME_HEADER = struct.Struct(">BI16s16s")
+# Larger frames are refused before reading them, and larger messages
+# before decompressing all of them
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Smaller messages aren't worth compressing
+COMPRESS_THRESHOLD = 1024
+# Larger messages are compressed and decompressed on a worker thread, so
+# other connections aren't held up meanwhile
+OFFLOAD_THRESHOLD = 64 * 1024
 
-def get_encryption_key():
-    """Get encryption key from config"""
+
+def derive_encryption_key(cfg):
+    """Derive the encryption key from the config"""
     # should be 32 bytes hex
     # https://pycryptodome.readthedocs.io/en/latest/src/cipher/aes.html
     default_key = "87b9b70e722d20c046c8dba8d0add1f16307fec33debffec9d001fd20dbca3ee"
-    return bytes.fromhex(config.get("shared_secret", default_key))
+    return bytes.fromhex(cfg.get_str("shared_secret", default_key))
+
+
+def get_encryption_key():
+    """Get encryption key, derived again only when the config changes"""
+    return config.derive("encryption_key", derive_encryption_key)
+
+
+def compress(codec, data):
+    """Compress a message with the named codec"""
+    if codec == "zlib":
+        return zlib.compress(data)
+    # The default preset is several times slower for little gain on JSON
+    return lzma.compress(data, preset=1)
+
+
+async def run_blocking(size, func, *args):
+    """Call func on a worker thread if size is large, else right away"""
+    if size < OFFLOAD_THRESHOLD:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+
+def decompress(frame_type, data):
+    """
+    Decompress a message sent as the given frame type
+
+    Returns:
+        The message, or None if it is corrupt or too large
+    """
+    if frame_type == FRAME_ZLIB:
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = lzma.LZMADecompressor()
+    try:
+        message = decompressor.decompress(data, MAX_FRAME_SIZE)
+    except (zlib.error, lzma.LZMAError):
+        return None
+    if not decompressor.eof:
+        return None
+    return message
 
 
 class Channel:
     """Encrypted bidirectional communication channel"""
 
-    def __init__(self, reader, writer):
+    def __init__(self, reader, writer, binary=False):
+        """
+        Args:
+            reader: asyncio StreamReader
+            writer: asyncio StreamWriter
+            binary: Send binary frames rather than hex lines. Updated
+                to the format of each message received, so a server
+                answers clients in the format they speak.
+        """
         self.reader = reader
         self.writer = writer
+        self.binary = binary
+        # Reused for decrypting binary frames, grown as needed
+        self.buffer = bytearray(4096)
+        # Codecs both ends can decompress, the preferred one first
+        self.codecs = []
 
     async def readline(self):
-        """Read a line from the channel"""
-        if not (line := await self.reader.readline()):
+        """
+        Read a line from the channel
+
+        Lines can be longer than the stream's buffer limit, since clients
+        send their first message as hex lines whatever its size.
+        """
+        chunks = []
+        size = 0
+        while True:
+            try:
+                chunks.append(await self.reader.readuntil(b"\n"))
+                break
+            except asyncio.LimitOverrunError as e:
+                # Take what is buffered and carry on looking for the end
+                chunks.append(await self.reader.readexactly(e.consumed))
+                size += e.consumed
+                if size > 2 * MAX_FRAME_SIZE:
+                    print("error: message is too large", file=sys.stderr)
+                    self.writer.close()
+                    return None
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.writer.close()
+                return None
+        # Strip the newline
+        return b"".join(chunks)[:-1].decode()
+
+    async def readexactly(self, size):
+        """Read size bytes from the channel"""
+        try:
+            return await self.reader.readexactly(size)
+        except (asyncio.IncompleteReadError, ConnectionError):
             self.writer.close()
             return None
-        # Strip the newline
-        return line[:-1].decode()
+
+    def accept(self, accept):
+        """
+        Answer in what a client said it understands
+
+        Args:
+            accept: {"binary": True, "compression": codecs} with the codecs
+                the client can decompress, its preferred one first
+
+        Returns:
+            {"compression": codecs} with those this end can use too, so
+            the client compresses with them in turn
+        """
+        if not isinstance(accept, dict):
+            accept = {}
+        if accept.get("binary"):
+            self.binary = True
+        offered = accept.get("compression")
+        if not isinstance(offered, list):
+            offered = []
+        self.codecs = [codec for codec in offered if codec in CODECS]
+        return {"compression": self.codecs}
 
     async def receive(self):
-        """Receive and decrypt a message"""
+        """Receive and decrypt a message in either format"""
+        if (first := await self.readexactly(1)) is None:
+            return None
+        if first[0] in [FRAME_PLAIN, FRAME_ZLIB, FRAME_LZMA]:
+            self.binary = True
+            return await self.receive_frame(first)
+        # Hex lines start with the nonce
+        if first not in b"0123456789abcdefABCDEF":
+            print(f"error: unknown frame type {first[0]}", file=sys.stderr)
+            self.writer.close()
+            return None
+        self.binary = False
+        try:
+            return await self.receive_lines(first.decode())
+        except ValueError:
+            print("error: malformed message", file=sys.stderr)
+            self.writer.close()
+            return None
+
+    async def receive_frame(self, first):
+        """Receive a binary frame after its first byte"""
+        if (rest := await self.readexactly(FRAME_HEADER.size - 1)) is None:
+            return None
+        frame_type, size, nonce, tag = FRAME_HEADER.unpack(first + rest)
+        if size > MAX_FRAME_SIZE:
+            print(f"error: frame of {size} bytes is too large", file=sys.stderr)
+            self.writer.close()
+            return None
+        if (ciphertext := await self.readexactly(size)) is None:
+            return None
+
+        if len(self.buffer) < size:
+            self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+        plaintext = memoryview(self.buffer)[:size]
+
+        # Decrypt
+        cipher = AES.new(get_encryption_key(), AES.MODE_EAX, nonce=nonce)
+        cipher.decrypt(ciphertext, output=plaintext)
+        try:
+            cipher.verify(tag)
+        except ValueError:
+            print("error: key incorrect or message corrupted", file=sys.stderr)
+            self.writer.close()
+            return None
+
+        if frame_type != FRAME_PLAIN:
+            message = await run_blocking(size, decompress, frame_type, plaintext)
+            if message is None:
+                print("error: message corrupted or too large", file=sys.stderr)
+                self.writer.close()
+                return None
+        else:
+            message = plaintext
+        try:
+            return json.loads(str(message, "utf-8"))
+        except ValueError:
+            print("error: malformed message", file=sys.stderr)
+            self.writer.close()
+            return None
+
+    async def receive_lines(self, first):
+        """Receive a message as hex lines, after the first character"""
         if (nonce := await self.readline()) is None:
             return None
         if (ciphertext := await self.readline()) is None:
@@ -39,7 +227,7 @@ class Channel:
         if (tag := await self.readline()) is None:
             return None
 
-        nonce = bytes.fromhex(nonce)
+        nonce = bytes.fromhex(first + nonce)
         ciphertext = bytes.fromhex(ciphertext)
         tag = bytes.fromhex(tag)
 
@@ -50,6 +238,7 @@ class Channel:
             cipher.verify(tag)
         except ValueError:
             print("error: key incorrect or message corrupted", file=sys.stderr)
+            self.writer.close()
             return None
 
         message = plaintext.decode()
@@ -60,12 +249,29 @@ class Channel:
         """Encrypt and send a message"""
         message = json.dumps(obj)
         data = message.encode()
+        # Receiving can change the format while compressing
+        binary = self.binary
+
+        # Compress before encrypting, ciphertext doesn't compress
+        frame_type = FRAME_PLAIN
+        if binary and self.codecs and len(data) >= COMPRESS_THRESHOLD:
+            compressed = await run_blocking(len(data), compress,
+                                            self.codecs[0], data)
+            if len(compressed) < len(data):
+                data, frame_type = compressed, CODECS[self.codecs[0]]
 
         # Encrypt
         cipher = AES.new(get_encryption_key(), AES.MODE_EAX)
         nonce = cipher.nonce
         ciphertext, tag = cipher.encrypt_and_digest(data)
 
+        if binary:
+            self.writer.write(FRAME_HEADER.pack(
+                frame_type, len(ciphertext), nonce, tag))
+            self.writer.write(ciphertext)
+            await self.writer.drain()
+            return
+
         # Encode as hex strings since the bytes might contain new lines
         nonce = nonce.hex().encode()
         ciphertext = ciphertext.hex().encode()
@@ -4,14 +4,140 @@ import asyncio
 import random
 import sys
 
-from .net import Channel
+from .net import CODECS, Channel
 from . import config
 
 
+def request_key(message):
+    """Id a response is matched by, the first one for a batch"""
+    if isinstance(message, list):
+        return message[0].get("id") if message else None
+    return message.get("id")
+
+
+def with_accept(request, accept):
+    """Add what the client understands to a request, the first of a batch"""
+    if isinstance(request, list):
+        return [dict(request[0], accept=accept)] + request[1:]
+    return dict(request, accept=accept)
+
+
+def client_accept():
+    """
+    What to ask the server for in the first requests, None for nothing
+
+    Returns:
+        {"binary": True, "compression": codecs} with the codecs the
+        client can decompress, the one chosen in the config first
+    """
+    if config.get_str("framing", "auto") == "hex":
+        return None
+    codec = config.get_str("compression", "zlib")
+    codecs = []
+    if codec in CODECS:
+        codecs = [codec] + [other for other in CODECS if other != codec]
+    return {"binary": True, "compression": codecs}
+
+
+def server_accept(response):
+    """The server's answer to client_accept(), None if it has none"""
+    if isinstance(response, list):
+        response = response[0] if response else None
+    if not isinstance(response, dict):
+        return None
+    return response.get("accept")
+
+
+class Connection:
+    """
+    Channel shared by concurrent queries
+
+    Responses can come back in any order and are matched to the waiting
+    query by the request id.
+    """
+
+    def __init__(self, channel, accept=None):
+        """
+        Args:
+            channel: Channel to the server
+            accept: From client_accept(), added to requests until the
+                server answers it
+        """
+        self.channel = channel
+        self.accept = accept
+        # Request id -> future of its response
+        self.pending = {}
+        self.reader = asyncio.create_task(self.read_responses())
+
+    @property
+    def closed(self):
+        """Whether the connection is gone, possibly closed by the server"""
+        return self.reader.done()
+
+    async def read_responses(self):
+        """Hand each response to the query waiting for it"""
+        try:
+            while (response := await self.channel.receive()) is not None:
+                # Servers from before binary frames ignore the request
+                # and keep answering in hex lines without compression
+                if (answer := server_accept(response)) is not None:
+                    self.use_accept(answer)
+                future = self.pending.pop(request_key(response), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except ConnectionError:
+            self.channel.writer.close()
+        finally:
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_result(None)
+
+    def use_accept(self, answer):
+        """Compress with the codecs the server said it can decompress"""
+        self.accept = None
+        codecs = answer.get("compression") if isinstance(answer, dict) else None
+        if isinstance(codecs, list):
+            self.channel.codecs = [codec for codec in codecs if codec in CODECS]
+
+    async def request(self, request):
+        """
+        Send a request and wait for the response
+
+        Returns:
+            (sent, response) where response is None if disconnected, and
+            sent is False only when the connection was known to be closed
+            before the request was written, so the server never saw it
+        """
+        if (self.closed or self.channel.reader.at_eof()
+                or self.channel.writer.is_closing()):
+            return False, None
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_key(request)] = future
+        # Even the first request says what the client understands, so
+        # the reply to it can already be binary and compressed
+        if self.accept is not None:
+            request = with_accept(request, self.accept)
+        try:
+            await self.channel.send(request)
+        except ConnectionError:
+            self.channel.writer.close()
+        return True, await future
+
+    async def close(self):
+        self.channel.writer.close()
+        try:
+            await self.channel.writer.wait_closed()
+        except ConnectionError:
+            pass
+        await asyncio.wait([self.reader])
+
+
 class RPCClient:
     """Generic RPC client for making requests to tau servers"""
 
-    def __init__(self, server=None, port=7643, protocol_version=1):
+    def __init__(self, server=None, port=7643, protocol_version=1,
+                 pool_size=1, idempotent=()):
         """
         Initialize RPC client
 
@@ -19,18 +145,81 @@ class RPCClient:
             server: Server hostname (defaults to 'server' config or 'localhost')
             port: Server port number
             protocol_version: RPC protocol version
+            pool_size: Connections kept open for later queries. Queries
+                made at the same time share them.
+            idempotent: Methods which can safely be handled twice, such
+                as reads. They are sent again when the connection drops
+                before their response arrives.
         """
         if server is None:
-            server = config.get("server", "localhost")
+            server = config.get_str("server", "localhost")
         self.server = server
         self.port = port
         self.protocol_version = protocol_version
+        self.pool_size = pool_size
+        self.idempotent = set(idempotent)
+        self.connections = []
+        # Connections belong to the event loop they were opened in
+        self.loop = None
+        self.connecting = None
 
     async def create_channel(self):
         """Create an encrypted channel to the server"""
         reader, writer = await asyncio.open_connection(self.server, self.port)
-        channel = Channel(reader, writer)
-        return channel
+        # Servers from before binary frames only understand hex lines,
+        # so by default they are used until the server answers in binary
+        binary = config.get_str("framing", "auto") == "binary"
+        return Channel(reader, writer, binary)
+
+    async def connection(self):
+        """
+        Pick the connection with the fewest queries waiting on it
+
+        Connects when there is none yet, or when all are busy and fewer
+        than pool_size are open.
+
+        Returns:
+            The connection
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.connections = []
+            self.loop = loop
+            self.connecting = asyncio.Lock()
+        # Queries starting together share the first connection made
+        async with self.connecting:
+            self.connections = [conn for conn in self.connections
+                                if not conn.closed]
+            if self.connections:
+                conn = min(self.connections, key=lambda c: len(c.pending))
+                if not conn.pending or len(self.connections) >= self.pool_size:
+                    return conn
+            conn = Connection(await self.create_channel(), client_accept())
+            self.connections.append(conn)
+            return conn
+
+    async def close(self):
+        """Close the connections to the server"""
+        connections, self.connections = self.connections, []
+        for conn in connections:
+            await conn.close()
+
+    async def request(self, request):
+        """
+        Send a request or a batch of them and return the response,
+        None if disconnected
+        """
+        requests = request if isinstance(request, list) else [request]
+        idempotent = all(r["method"] in self.idempotent for r in requests)
+        conn = await self.connection()
+        sent, response = await conn.request(request)
+        # An idle connection can be closed by the server meanwhile. Only
+        # try again on a new one when the server can't have handled the
+        # request, since other requests failing can also drop it.
+        if response is None and (not sent or idempotent):
+            conn = await self.connection()
+            _, response = await conn.request(request)
+        return response
 
     def random_id(self):
         """Generate random request ID"""
@@ -50,16 +239,14 @@ class RPCClient:
         Raises:
             SystemExit: If connection fails or server returns error
         """
-        channel = await self.create_channel()
         request = {
             "id": self.random_id(),
             "method": method,
             "params": params,
             "protocol_version": self.protocol_version,
         }
-        await channel.send(request)
+        response = await self.request(request)
 
-        response = await channel.receive()
         # Closed connection returns None
         if response is None:
             print("error: connection with server was closed", file=sys.stderr)
@@ -72,3 +259,92 @@ class RPCClient:
             sys.exit(-1)
 
         return response["result"]
+
+    async def batch(self, calls, partial=False):
+        """
+        Make several RPC calls in one message
+
+        The server handles them concurrently, so they shouldn't depend
+        on each other.
+
+        Args:
+            calls: List of (method, params) pairs
+            partial: Return the results of the calls which succeeded,
+                with None for those which failed, rather than exiting.
+                The errors are printed either way.
+
+        Returns:
+            List of the results, in the order of the calls
+
+        Raises:
+            SystemExit: If connection fails, or unless partial is set,
+                if the server returns an error for any of the calls
+        """
+        if not calls:
+            return []
+        ids = set()
+        while len(ids) < len(calls):
+            ids.add(self.random_id())
+        requests = [{
+            "id": id,
+            "method": method,
+            "params": params,
+            "protocol_version": self.protocol_version,
+        } for id, (method, params) in zip(ids, calls)]
+        responses = await self.request(requests)
+
+        # Closed connection returns None
+        if responses is None:
+            print("error: connection with server was closed", file=sys.stderr)
+            sys.exit(-1)
+
+        errors = [response["error"] for response in responses
+                  if "error" in response]
+        for error in errors:
+            errcode, errmsg = error["code"], error["message"]
+            print(f"error: {errcode} - {errmsg}", file=sys.stderr)
+        if errors and not partial:
+            sys.exit(-1)
+
+        return [response["result"] if "error" not in response else None
+                for response in responses]
+
+    async def subscribe(self, method, params):
+        """
+        Make an RPC call which keeps pushing events, see rpc_server.Stream
+
+        Args:
+            method: Method name to call
+            params: List of parameters to pass
+
+        Yields:
+            Each event pushed by the server, until the connection closes
+
+        Raises:
+            SystemExit: If connection fails or server returns error
+        """
+        channel = await self.create_channel()
+        id = self.random_id()
+        request = {
+            "id": id,
+            "method": method,
+            "params": params,
+            "protocol_version": self.protocol_version,
+        }
+        if (accept := client_accept()) is not None:
+            request = with_accept(request, accept)
+        await channel.send(request)
+
+        while (message := await channel.receive()) is not None:
+            if "subscription" in message:
+                if message["subscription"] == id:
+                    yield message["event"]
+                continue
+            if "error" in message:
+                error = message["error"]
+                errcode, errmsg = error["code"], error["message"]
+                print(f"error: {errcode} - {errmsg}", file=sys.stderr)
+                sys.exit(-1)
+
+        print("error: connection with server was closed", file=sys.stderr)
+        sys.exit(-1)
@@ -3,24 +3,175 @@
 import asyncio
 import json
 
+from . import config
 from .net import Channel
 
+# Requests handled at once on a connection before reading more waits
+MAX_IN_FLIGHT = 64
+# Error codes of a request in a batch which is malformed, or which
+# failed without the handler returning an error
+INVALID_REQUEST = 53
+INTERNAL_ERROR = 54
+
+
+class Stream:
+    """
+    Reply which keeps pushing messages on the connection after it is sent
+
+    Each message is sent as {"subscription": id, "event": message} with
+    the id of the request, so it can't be confused with a reply.
+    """
+
+    def __init__(self, result, messages, close=None):
+        """
+        Args:
+            result: Result sent as the normal reply
+            messages: Async iterator of the messages to push
+            close: Called once the connection is gone
+        """
+        self.result = result
+        self.messages = messages
+        self.close = close
+        self.response = None
+
+
+async def push_stream(channel, id, stream):
+    """Forward the messages of a stream until it ends or is cancelled"""
+    try:
+        async for message in stream.messages:
+            await channel.send({"subscription": id, "event": message})
+    except ConnectionError:
+        pass
+
+
+def error_response(request, code, message):
+    """Response to a request the handler couldn't answer itself"""
+    return {
+        "id": request.get("id") if isinstance(request, dict) else None,
+        "result": None,
+        "error": {"code": code, "message": message},
+    }
+
+
+def invalid_request(request):
+    """Why a request can't be handed to the handler, None if it can"""
+    if not isinstance(request, dict):
+        return "request is not an object"
+    for key in ["id", "method", "params", "protocol_version"]:
+        if key not in request:
+            return f"request has no {key}"
+    if not isinstance(request["params"], list):
+        return "params is not a list"
+    return None
+
+
+async def handle_batched(request, api_handler):
+    """Handle one request of a batch, answering any failure with an error"""
+    if (reason := invalid_request(request)) is not None:
+        return error_response(request, INVALID_REQUEST, reason)
+    try:
+        return await api_handler(request)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        return error_response(request, INTERNAL_ERROR, "internal error")
+
+
+async def handle_request(channel, request, api_handler, pushers,
+                         accepted=None):
+    """
+    Handle a request and send its response
+
+    A request can also be a batch, a list of requests sent in one
+    message. They are handled concurrently, so in no particular order,
+    and their responses are sent back together as a list in the same
+    order as the requests. A request of a batch which is malformed or
+    fails gets an error response while the others are answered as usual.
+
+    Args:
+        accepted: Answer to what the client listed in the request, added
+            to the response, the first of a batch
+    """
+    try:
+        if isinstance(request, list):
+            requests = request
+            responses = list(await asyncio.gather(
+                *[handle_batched(request, api_handler)
+                  for request in requests]))
+        else:
+            requests = [request]
+            responses = [await api_handler(request)]
+
+        streams = []
+        for i, response in enumerate(responses):
+            if isinstance(response, Stream):
+                streams.append((requests[i]["id"], response))
+                responses[i] = response.response
+        if (accepted is not None and responses
+                and isinstance(responses[0], dict)):
+            responses[0] = dict(responses[0], accept=accepted)
+        response = responses if isinstance(request, list) else responses[0]
+        print("response:")
+        print(json.dumps(response, indent=2))
+
+        await channel.send(response)
+        for id, stream in streams:
+            # The connection may have closed while it was handled
+            if channel.writer.is_closing():
+                if stream.close is not None:
+                    stream.close()
+                continue
+            # Requests keep being served while the stream is pushed
+            pusher = asyncio.create_task(push_stream(channel, id, stream))
+            pushers.append((pusher, stream))
+    except ConnectionError:
+        pass
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        # The client would wait forever for the lost response
+        channel.writer.close()
+
+
+def requested_accept(request):
+    """What the client understands, listed in a request or a batch's first"""
+    if isinstance(request, list):
+        request = request[0] if request else None
+    if not isinstance(request, dict):
+        return None
+    return request.get("accept")
+
 
 async def handle_rpc_connection(reader, writer, api_handler):
     """
     Handle a single RPC connection
 
+    Each request is handled in its own task, so a slow request doesn't
+    hold up the ones after it. Responses are sent as they are ready and
+    clients match them to requests by id.
+
     Args:
         reader: asyncio StreamReader
         writer: asyncio StreamWriter
-        api_handler: Async function that processes requests and returns responses
+        api_handler: Async function that processes requests and returns
+            responses, or a Stream with the response set
     """
+    pushers = []
+    handlers = set()
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+    def handler_done(handler):
+        handlers.discard(handler)
+        in_flight.release()
+
     try:
         addr = writer.get_extra_info("peername")
         print(f"Received connection from {addr}")
         channel = Channel(reader, writer)
 
         while True:
+            # Stop reading while too many requests are in progress
+            await in_flight.acquire()
             request = await channel.receive()
             if request is None:
                 print("Channel closed")
@@ -28,16 +179,28 @@ async def handle_rpc_connection(reader, writer, api_handler):
 
             print("request:")
             print(json.dumps(request, indent=2))
+            # Clients say what they understand in their first requests,
+            # so even the first reply can use it
+            accepted = None
+            if (accept := requested_accept(request)) is not None:
+                accepted = channel.accept(accept)
 
-            response = await api_handler(request)
-            print("response:")
-            print(json.dumps(response, indent=2))
-
-            await channel.send(response)
+            handler = asyncio.create_task(handle_request(
+                channel, request, api_handler, pushers, accepted))
+            handlers.add(handler)
+            handler.add_done_callback(handler_done)
 
     except Exception:
         import traceback
         traceback.print_exc()
+    finally:
+        # Let requests finish, a change may be half written otherwise
+        if handlers:
+            await asyncio.wait(handlers)
+        for pusher, stream in pushers:
+            pusher.cancel()
+            if stream.close is not None:
+                stream.close()
 
 
 async def run_rpc_server(host, port, api_handler):
@@ -50,6 +213,7 @@ async def run_rpc_server(host, port, api_handler):
         api_handler: Async function that processes requests and returns responses
     """
     print(f"Server starting on {host}:{port}")
+    config.reload_on_sighup(asyncio.get_running_loop())
 
     async def connection_handler(reader, writer):
         await handle_rpc_connection(reader, writer, api_handler)
@@ -63,6 +63,11 @@ task_template = {
     "events": list,
 }
 
+# Named field projections for the task list endpoints
+task_views = {
+    "summary": ["title", "status", "project", "tags", "assigned", "rank", "due"],
+}
+
 
 def enforce_task_format(task):
     """Validate task format against template"""
@@ -72,3 +77,19 @@ def enforce_task_format(task):
             assert val_type == list or attr not in ["blob_idx", "created"]
             continue
         assert isinstance(val, val_type)
+
+
+def apply_event(task, event):
+    """Apply an event from a task's history to the task's attributes"""
+    cmd = event[0]
+    if cmd == "set":
+        attr, val = event[3], event[4]
+        task[attr] = val
+    elif cmd == "append":
+        attr, val = event[3], event[4]
+        task[attr].append(val)
+    elif cmd == "remove":
+        attr, val = event[3], event[4]
+        task[attr].remove(val)
+    elif cmd == "status":
+        task["status"] = event[3]
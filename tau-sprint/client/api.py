@@ -2,8 +2,11 @@
 """tau-sprint client API - RPC wrapper"""
 from tau_core.rpc_client import RPCClient
 
-# Create RPC client for tau-sprint server (port 7644)
-client = RPCClient(port=7644)
+# Create RPC client for tau-sprint server (port 7644). Reads can be
+# retried when the connection drops, changes can't.
+client = RPCClient(port=7644, idempotent=[
+    "list_sprints", "get_sprint", "get_tasks_for_sprint",
+    "get_tasks_for_story", "get_burndown_for_sprint"])
 
 
 # Sprint management
@@ -32,6 +35,17 @@ async def add_story_to_sprint(sprint_id, task_id):
     return await client.query("add_story_to_sprint", [sprint_id, task_id])
 
 
+async def add_stories_to_sprint(sprint_id, task_ids):
+    """
+    Add several stories in one round trip, returns their snapshots
+
+    The snapshot is None for each story that couldn't be added, after
+    its error was printed.
+    """
+    return await client.batch([("add_story_to_sprint", [sprint_id, task_id])
+                               for task_id in task_ids], partial=True)
+
+
 async def reorder_stories(sprint_id, order):
     return await client.query("reorder_stories", [sprint_id, order])
 
@@ -46,6 +60,12 @@ async def get_tasks_for_sprint(sprint_id):
     return await client.query("get_tasks_for_sprint", [sprint_id])
 
 
+async def get_tasks_for_sprints(sprint_ids):
+    """Get the tasks of several sprints in one round trip"""
+    return await client.batch([("get_tasks_for_sprint", [sprint_id])
+                               for sprint_id in sprint_ids])
+
+
 async def get_tasks_for_story(sprint_id, parent_task_id):
     return await client.query("get_tasks_for_story", [sprint_id, parent_task_id])
 
@@ -134,17 +134,16 @@ async def cmd_complete(sprint_id):
 async def cmd_add_story(sprint_id, task_ids):
     """Add stories to sprint"""
     added = 0
-    for task_id in task_ids:
-        tid = int(task_id)
-        snapshot = await api.add_story_to_sprint(sprint_id, tid)
+    tids = [int(task_id) for task_id in task_ids]
+    snapshots = await api.add_stories_to_sprint(sprint_id, tids)
+    # The others are still added when some fail, and the errors of
+    # those were printed already
+    for tid, snapshot in zip(tids, snapshots):
         if snapshot:
             print(f"  Story #{tid}: {snapshot['title']}")
             added += 1
-        else:
-            print(f"Error: Task #{tid} not found in tau2", file=sys.stderr)
-            return -1
     print(f"Added {added} story(ies) to sprint {sprint_id}")
-    return 0
+    return 0 if added == len(tids) else -1
 
 
 async def cmd_breakdown(sprint_id, parent_task_id, breakdown_args):
@@ -384,8 +383,8 @@ async def cmd_velocity():
     headers = ["Sprint", "Completed Hours"]
     rows = []
     total = 0
-    for s in completed:
-        tasks = await api.get_tasks_for_sprint(s["id"])
+    sprint_tasks = await api.get_tasks_for_sprints([s["id"] for s in completed])
+    for s, tasks in zip(completed, sprint_tasks):
         completed_hours = sum(t["actual_hours"] for t in tasks if t["status"] == "done")
         rows.append([f"{s['id']}: {s['name']}", f"{completed_hours}h"])
         total += completed_hours
@@ -531,5 +530,13 @@ async def main():
         return -1
 
 
+async def run():
+    """Run the command, then close the connections kept to the server"""
+    try:
+        return await main()
+    finally:
+        await api.client.close()
+
+
 if __name__ == "__main__":
-    sys.exit(asyncio.run(main()))
+    sys.exit(asyncio.run(run()))